@@ -0,0 +1,284 @@
+"""
+Stage-level benchmarks for the coin counter application.
+
+Generates synthetic coin images offline, times each pipeline stage and the
+end-to-end pipeline, and optionally compares the timings to a stored baseline.
+With --startup it also times the command line start-up in fresh interpreters
+and checks that counting one image loads none of HEAVY_MODULES.
+
+Usage:
+    python benchmark.py --sizes 640x480 1600x1200 --startup --save-baseline baseline.json
+    python benchmark.py --sizes 640x480 1600x1200 --startup --baseline baseline.json
+"""
+import argparse
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from preprocessing import convert_to_grayscale, adjust_contrast, apply_gaussian_blur
+from segmentation import otsu_threshold, segment_coins, erode, dilate, filter_coins
+from counting import count_coins
+from pipeline import run_pipeline
+
+# Modules only the dataset, evaluation, plotting and web commands need
+HEAVY_MODULES = ('pandas', 'matplotlib', 'kagglehub', 'flask')
+
+_REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def generate_coin_image(width=1600, height=1200, num_coins=10, radius_range=(40, 90),
+                        touching=0, noise=8.0, seed=0):
+    """
+    Generate a synthetic image of coins on a plain background.
+    
+    Coins are bright discs on a dark background. Colours are kept below 85
+    per channel so that the channel sum fits in uint8, as convert_to_grayscale
+    requires for a faithful average.
+    
+    Parameters:
+    width, height: Image size in pixels
+    num_coins: Number of coins to draw
+    radius_range: (min, max) coin radius in pixels
+    touching: How many of the coins are placed touching another coin (the
+              pipeline may count touching coins as one)
+    noise: Standard deviation of the Gaussian pixel noise
+    seed: Random seed
+    
+    Returns:
+    PIL.Image: The generated image
+    """
+    rng = np.random.default_rng(seed)
+    image = np.empty((height, width, 3), dtype=np.float32)
+    image[:] = rng.uniform(15, 30, size=3)
+    
+    rows, cols = np.ogrid[:height, :width]
+    coins = []  # (row, col, radius)
+    attempts = 0
+    while len(coins) < num_coins and attempts < num_coins * 200:
+        attempts += 1
+        radius = rng.uniform(*radius_range)
+        if coins and len(coins) > num_coins - 1 - touching:
+            # Place the coin tangent to a random existing coin
+            other_row, other_col, other_radius = coins[rng.integers(len(coins))]
+            angle = rng.uniform(0, 2 * np.pi)
+            distance = other_radius + radius
+            row, col = other_row + distance * np.sin(angle), other_col + distance * np.cos(angle)
+            gap = -1.0
+        else:
+            row, col = rng.uniform(radius, height - radius), rng.uniform(radius, width - radius)
+            gap = 0.25 * radius
+        
+        # Keep coins inside the image and separated from the others
+        margin = radius + 4
+        if not (margin <= row <= height - margin and margin <= col <= width - margin):
+            continue
+        if any(np.hypot(row - r, col - c) < radius + rr + gap for r, c, rr in coins):
+            continue
+        
+        coins.append((row, col, radius))
+        disc = (rows - row) ** 2 + (cols - col) ** 2 <= radius ** 2
+        image[disc] = rng.uniform(55, 80, size=3)
+    
+    image += rng.normal(0, noise, size=image.shape)
+    return Image.fromarray(np.clip(image, 0, 255).astype(np.uint8))
+
+def _time(function, repeat):
+    """Run a function repeat times and return (median seconds, last result)."""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result
+
+def benchmark_image(image, scale=2, repeat=3):
+    """
+    Time each pipeline stage and the end-to-end pipeline on one image.
+    
+    Returns:
+    dict: Stage name -> {'seconds': median wall time, 'mpix_per_s': input megapixels per second}
+    """
+    encoded = io.BytesIO()
+    image.save(encoded, format="JPEG", quality=90)
+    encoded = encoded.getvalue()
+    
+    def decode():
+        decoded = Image.open(io.BytesIO(encoded))
+        decoded.load()
+        return decoded
+    
+    timings = {}
+    
+    def run(name, function, input_image):
+        seconds, result = _time(function, repeat)
+        megapixels = np.asarray(input_image).shape[0] * np.asarray(input_image).shape[1] / 1e6
+        timings[name] = {
+            'seconds': seconds,
+            'mpix_per_s': megapixels / seconds if seconds > 0 else float('inf'),
+        }
+        return result
+    
+    run('decode', decode, image)
+    gray = run('convert_to_grayscale', lambda: convert_to_grayscale(image, scale), image)
+    contrast = run('adjust_contrast', lambda: adjust_contrast(gray, 1.5), gray)
+    blurred = run('apply_gaussian_blur', lambda: apply_gaussian_blur(contrast), contrast)
+    run('otsu_threshold', lambda: otsu_threshold(blurred), blurred)
+    segmented = run('segment_coins', lambda: segment_coins(blurred), blurred)
+    eroded = run('erode', lambda: erode(segmented, 5), segmented)
+    run('dilate', lambda: dilate(eroded, 1), eroded)
+    filtered = run('filter_coins', lambda: filter_coins(segmented), segmented)
+    run('count_coins', lambda: count_coins(filtered), filtered)
+    run('pipeline', lambda: run_pipeline(decode(), ('count',), scale=scale), image)
+    return timings
+
+def run_benchmarks(sizes, num_coins=12, scale=2, repeat=3, seed=0, touching=0, noise=8.0, max_radius=None):
+    """
+    Benchmark every stage on synthetic images of the given sizes.
+    
+    Parameters:
+    sizes: List of (width, height) tuples
+    touching, noise: As for generate_coin_image
+    max_radius: Largest coin radius in pixels (default: scaled to fit
+                num_coins in the image); the smallest is 0.6 times that
+    
+    Returns:
+    dict: 'WIDTHxHEIGHT' -> stage timings (see benchmark_image)
+    """
+    report = {}
+    for width, height in sizes:
+        radius = max_radius or min(width, height) / (4 * np.sqrt(num_coins))
+        image = generate_coin_image(width, height, num_coins, (0.6 * radius, radius), touching, noise, seed)
+        report[f"{width}x{height}"] = benchmark_image(image, scale, repeat)
+    return report
+
+def _run_python(code):
+    """
+    Run code in a fresh interpreter from the repository directory.
+    
+    Returns:
+    tuple: (wall seconds, heavy modules the code left loaded)
+    """
+    script = (f"import sys\ntry:\n" + "".join(f"    {line}\n" for line in code.splitlines()) +
+              f"finally:\n    print('LOADED:' + ','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n")
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, '-c', script], cwd=_REPO_DIR,
+                               capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    if completed.returncode != 0:
+        raise RuntimeError(f"Start-up benchmark failed:\n{completed.stderr}")
+    loaded = [line for line in completed.stdout.splitlines() if line.startswith('LOADED:')]
+    return seconds, [name for name in loaded[-1][len('LOADED:'):].split(',') if name]
+
+def benchmark_startup(repeat=3, seed=0):
+    """
+    Time the command line start-up in fresh interpreters.
+    
+    'import main' measures the import alone; 'count_image' runs
+    main.py --image IMAGE --no-viz on a small synthetic image, end to end.
+    
+    Returns:
+    dict: Case -> {'seconds': median wall time, 'mpix_per_s': None,
+          'heavy_modules': heavy modules the case loaded}
+    """
+    image = generate_coin_image(320, 240, 4, (20, 30), seed=seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image_path = os.path.join(tmp_dir, 'coins.jpg')
+        image.save(image_path, format="JPEG", quality=90)
+        cases = {
+            'import_main': "import main",
+            'count_image': (f"import runpy\nsys.argv = ['main.py', '--image', {image_path!r}, '--no-viz']\n"
+                            "runpy.run_path('main.py', run_name='__main__')"),
+        }
+        timings = {}
+        for name, code in cases.items():
+            runs = [_run_python(code) for _ in range(repeat)]
+            timings[name] = {
+                'seconds': statistics.median(seconds for seconds, _ in runs),
+                'mpix_per_s': None,
+                'heavy_modules': runs[-1][1],
+            }
+    return timings
+
+def print_report(report, baseline=None, tolerance=0.2):
+    """
+    Print per-stage timings, with the change against a baseline if given.
+    
+    Returns:
+    list: (size, stage, ratio) for every stage slower than the baseline by more than tolerance
+    """
+    regressions = []
+    for size, timings in report.items():
+        print(f"\n{size}")
+        print(f"  {'stage':<22}{'ms':>10}{'MP/s':>10}" + (f"{'vs baseline':>14}" if baseline else ""))
+        for stage, timing in timings.items():
+            throughput = timing['mpix_per_s']
+            line = f"  {stage:<22}{timing['seconds'] * 1000:>10.2f}" + (
+                f"{throughput:>10.1f}" if throughput is not None else f"{'-':>10}")
+            reference = (baseline or {}).get(size, {}).get(stage)
+            if reference:
+                ratio = timing['seconds'] / reference['seconds'] if reference['seconds'] > 0 else 1.0
+                flag = "  REGRESSION" if ratio > 1 + tolerance else ""
+                line += f"{ratio:>13.2f}x{flag}"
+                if flag:
+                    regressions.append((size, stage, ratio))
+            if timing.get('heavy_modules'):
+                line += f"  LOADS {', '.join(timing['heavy_modules'])}"
+                regressions.append((size, stage, None))
+            print(line)
+    return regressions
+
+def parse_size(text):
+    """Parse a 'WIDTHxHEIGHT' string."""
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+def main():
+    """Run the benchmarks from the command line."""
+    parser = argparse.ArgumentParser(description='Coin Counter stage benchmarks')
+    parser.add_argument('--sizes', nargs='+', type=parse_size, default=[(640, 480), (1600, 1200)],
+                        help='Image sizes as WIDTHxHEIGHT')
+    parser.add_argument('--coins', type=int, default=12, help='Number of coins per image')
+    parser.add_argument('--touching', type=int, default=0, help='Number of coins placed touching another coin')
+    parser.add_argument('--noise', type=float, default=8.0, help='Standard deviation of the pixel noise')
+    parser.add_argument('--max-radius', type=float,
+                        help='Largest coin radius in pixels (default: scaled to the image size)')
+    parser.add_argument('--scale', type=int, default=2, help='Scale factor for image resizing')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per stage (the median is reported)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the synthetic images')
+    parser.add_argument('--baseline', type=str, help='Compare against a baseline JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown against the baseline')
+    parser.add_argument('--save-baseline', type=str, help='Save the results as a baseline JSON file')
+    parser.add_argument('--startup', action='store_true',
+                        help='Also time the command line start-up and check it loads no heavy modules')
+    args = parser.parse_args()
+    
+    report = run_benchmarks(args.sizes, args.coins, args.scale, args.repeat, args.seed,
+                            args.touching, args.noise, args.max_radius)
+    if args.startup:
+        report['startup'] = benchmark_startup(args.repeat, args.seed)
+    
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = print_report(report, baseline, args.tolerance)
+    
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nBaseline saved to {args.save_baseline}")
+    
+    if regressions:
+        print(f"\n{len(regressions)} stage(s) slower than the baseline or loading heavy modules")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
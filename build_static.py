@@ -32,8 +32,10 @@ with open('dist/results.html', 'w', encoding='utf-8') as f:
     f.write(template.render(
         num_coins=0,
         size_differences=0,
-        original_image='',
-        labeled_image=''
+        original_url='',
+        labeled_url='',
+        original_full_url='',
+        labeled_full_url=''
     ))
 
 print("Static files built successfully in 'dist' directory")
\ No newline at end of file
@@ -0,0 +1,161 @@
+"""
+Content-addressed result cache for the coin counter application.
+"""
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+
+_MISSING = object()
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """Return the SHA-256 hex digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def make_cache_key(image_path, params):
+    """
+    Build a cache key from an image's content and the pipeline parameters.
+
+    Parameters:
+    image_path: Path to the image file
+    params: Dict of the parameters that affect the result
+
+    Returns:
+    str: Hex key that changes whenever the image content or a parameter changes
+    """
+    payload = json.dumps({"image": file_digest(image_path), "params": params}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def make_packed_cache_key(packed_digest, image_name, params):
+    """
+    Build a cache key for an image of a packed dataset, like make_cache_key.
+
+    Parameters:
+    packed_digest: file_digest of the packed file
+    image_name: Name of the image within the packed file (folder and file name)
+    params: Dict of the parameters that affect the result
+
+    Returns:
+    str: Hex key that changes whenever the packed file or a parameter changes
+    """
+    payload = json.dumps({"packed": packed_digest, "image": image_name, "params": params}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class ResultCache:
+    """
+    Cache of pipeline results keyed by make_cache_key.
+
+    Results are kept in memory with LRU eviction and, if cache_dir is given,
+    pickled to disk as a second tier that survives restarts. Concurrent
+    get_or_compute calls for the same key run the computation only once.
+    Results must not be None.
+    """
+
+    def __init__(self, max_entries=128, cache_dir=None, namespace="results"):
+        """
+        Parameters:
+        max_entries: Number of results kept in memory
+        cache_dir: Optional directory for the on-disk tier
+        namespace: Subdirectory of cache_dir, so different kinds of results
+                   can share a directory
+        """
+        self.max_entries = max(1, max_entries)
+        self.cache_dir = os.path.join(cache_dir, namespace) if cache_dir else None
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.pkl')
+
+    def _load(self, key):
+        """Read a result from the on-disk tier."""
+        if self.cache_dir is None:
+            return _MISSING
+        try:
+            with open(self._disk_path(key), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return _MISSING
+
+    def _store(self, key, value):
+        """Write a result to the on-disk tier atomically."""
+        if self.cache_dir is None:
+            return
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _remember(self, key, value):
+        """Add a result to the in-memory tier, evicting the least recently used."""
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        """Return the cached result for key, or None."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        value = self._load(key)
+        if value is _MISSING:
+            return None
+        self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        """Store a result in both tiers."""
+        self._remember(key, value)
+        self._store(key, value)
+
+    def get_or_compute(self, key, compute):
+        """
+        Return the cached result for key, computing and storing it if needed.
+
+        If another thread is already computing the same key, wait for it
+        instead of computing it again.
+        """
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    return self._entries[key]
+                event = self._in_flight.get(key)
+                owner = event is None
+                if owner:
+                    event = self._in_flight[key] = threading.Event()
+
+            if not owner:
+                # Retry once the other computation is done; if it failed,
+                # this thread becomes the owner and computes it itself
+                event.wait()
+                continue
+
+            try:
+                value = self._load(key)
+                if value is _MISSING:
+                    value = compute()
+                    self._store(key, value)
+                self._remember(key, value)
+                return value
+            finally:
+                with self._lock:
+                    del self._in_flight[key]
+                event.set()
@@ -1,56 +1,200 @@
 """
 Coin counting module for the coin counter application.
 """
+from functools import cached_property
+
 import numpy as np
 from scipy import ndimage as ndi
 from PIL import Image
 
-def count_coins(filtered_image, size_threshold=50):
+def count_size_differences(coin_sizes, size_threshold=50):
+    """
+    Count the significant size differences among coins.
+
+    Starting from 1, every pair of coins whose areas differ by at least
+    size_threshold adds one, and the result is capped at the number of coins.
+    The pairs are counted on the sorted sizes with a binary search, so this
+    runs in O(n log n) instead of comparing every pair.
+
+    Parameters:
+    coin_sizes: Area of each coin
+    size_threshold: Threshold for significant size differences between coins
+
+    Returns:
+    diff_count: Number of significant size differences detected among coins
+    """
+    sizes = np.sort(np.asarray(coin_sizes, dtype=np.int64))
+    num_coins = len(sizes)
+
+    if size_threshold <= 0:
+        # Every pair differs by at least a non-positive threshold
+        num_pairs = num_coins * (num_coins - 1) // 2
+    else:
+        # For each coin, count the coins at least size_threshold larger
+        first_larger = np.searchsorted(sizes, sizes + size_threshold, side='left')
+        num_pairs = int(np.sum(num_coins - first_larger))
+
+    # Apply a rule: the counter never exceeds the total number of coins
+    return min(1 + num_pairs, num_coins)
+
+def cluster_coin_sizes(coin_sizes, size_threshold=50):
+    """
+    Group coins into size classes.
+
+    Coins are sorted by area and a new class is started wherever two
+    consecutive areas differ by at least size_threshold.
+
+    Parameters:
+    coin_sizes: Area of each coin, where coin_sizes[k] belongs to label k + 1
+    size_threshold: Threshold for significant size differences between coins
+
+    Returns:
+    list: One dict per size class, from smallest to largest, with the member
+          'labels' and the 'min_size' and 'max_size' of the class
+    """
+    coin_sizes = np.asarray(coin_sizes, dtype=np.int64)
+    if len(coin_sizes) == 0:
+        return []
+
+    order = np.argsort(coin_sizes, kind='stable')
+    sorted_sizes = coin_sizes[order]
+    breaks = np.flatnonzero(np.diff(sorted_sizes) >= size_threshold) + 1
+
+    classes = []
+    for members in np.split(order, breaks):
+        member_sizes = coin_sizes[members]
+        classes.append({
+            "labels": (members + 1).tolist(),
+            "min_size": int(member_sizes.min()),
+            "max_size": int(member_sizes.max()),
+        })
+    return classes
+
+def count_coins(filtered_image, size_threshold=50, return_classes=False):
     """
     Count the number of coins and classify them by size.
     
     Parameters:
     filtered_image: Binary image after filtering (PIL Image)
     size_threshold: Threshold for significant size differences between coins
+    return_classes: Whether to also return the size classes (see cluster_coin_sizes)
     
     Returns:
     num_coins: Total number of coins detected
     size_differences: Number of significant size differences detected among coins
+    size_classes: Only if return_classes is True
     """
     # Convert the PIL Image to a NumPy array
-    binary_array = np.array(filtered_image)
+    return count_coins_array(np.asarray(filtered_image), size_threshold, return_classes)
 
-    # Label connected components (each coin gets a unique label)
-    labeled_array, num_coins = ndi.label(binary_array)
+def count_coins_array(binary_array, size_threshold=50, return_classes=False):
+    """
+    Count the coins of a boolean mask, as count_coins does for an image.
+    """
+    regions = label_coins(binary_array)
+    diff_count = regions.size_differences(size_threshold)
 
-    # Calculate the size of each labeled component (coin area)
-    sizes = np.bincount(labeled_array.ravel())
+    # Return the total number of coins detected and the number of significant differences
+    if return_classes:
+        return regions.num_coins, diff_count, regions.size_classes(size_threshold)
+    return regions.num_coins, diff_count
 
-    # Ignore the background (label 0) by setting its size to 0
-    sizes[0] = 0
+def _compact_labels(labeled_array, num_labels):
+    """Return the label array in the smallest unsigned integer type that holds num_labels."""
+    for dtype in (np.uint8, np.uint16):
+        if num_labels <= np.iinfo(dtype).max:
+            return labeled_array.astype(dtype)
+    return labeled_array
 
-    # Extract coin sizes (excluding the background label)
-    coin_sizes = sizes[1:]
+class CoinRegions:
+    """
+    Labeled coins of a mask with a per-coin region table.
 
-    # Initialize the counter for significant size differences
-    diff_count = 1
+    Counting, size classes, visualization and the JSON output all read this
+    one table instead of labeling the mask again. Areas are computed up
+    front; centroids, bounding boxes and diameters are computed in bulk the
+    first time they are read, so counting alone does not pay for them.
 
-    # Compare sizes of all coin pairs to detect significant differences
-    for i in range(len(coin_sizes)):
-        for j in range(i + 1, len(coin_sizes)):
-            # Calculate the difference between coin sizes
-            size_diff = abs(coin_sizes[i] - coin_sizes[j])
-            # If the difference exceeds the threshold, increment the counter
-            if size_diff >= size_threshold:
-                diff_count += 1
+    Attributes:
+    labels: Label array in the smallest unsigned type that fits (0 is background)
+    num_coins: Number of coins; coin k has label k + 1 and row k in each table
+    areas: Area of each coin in pixels
+    bboxes: Bounding box of each coin as [top, left, bottom, right], exclusive
+    centroids: Centroid of each coin as [row, col]
+    equivalent_diameters: Diameter of the disc with the same area as each coin
+    """
 
-    # Apply a rule: if the difference counter exceeds the total number of coins,
-    # set the counter to the total number of coins
-    if diff_count > num_coins:
-        diff_count = num_coins
+    def __init__(self, labels, num_coins):
+        self.labels = _compact_labels(np.asarray(labels), num_coins)
+        self.num_coins = num_coins
+        self.areas = np.bincount(self.labels.ravel(), minlength=num_coins + 1)[1:].astype(np.int64)
 
-    # Return the total number of coins detected and the number of significant differences
-    return num_coins, diff_count
+    @cached_property
+    def centroids(self):
+        """Centroid of each coin as [row, col], from coordinate sums per label."""
+        rows, cols = np.nonzero(self.labels)
+        coin_labels = self.labels[rows, cols]
+        sums = np.stack([np.bincount(coin_labels, weights=rows, minlength=self.num_coins + 1)[1:],
+                         np.bincount(coin_labels, weights=cols, minlength=self.num_coins + 1)[1:]], axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums / self.areas[:, None]
+
+    @cached_property
+    def bboxes(self):
+        """Bounding box of each coin as [top, left, bottom, right], exclusive."""
+        bboxes = np.zeros((self.num_coins, 4), dtype=np.int64)
+        for index, box in enumerate(ndi.find_objects(self.labels, self.num_coins)):
+            if box is not None:
+                bboxes[index] = (box[0].start, box[1].start, box[0].stop, box[1].stop)
+        return bboxes
+
+    @cached_property
+    def equivalent_diameters(self):
+        """Diameter of the disc with the same area as each coin."""
+        return 2 * np.sqrt(self.areas / np.pi)
+
+    def size_differences(self, size_threshold=50):
+        """Count the significant size differences among the coins (see count_size_differences)."""
+        return count_size_differences(self.areas, size_threshold)
+
+    def count(self, size_threshold=50):
+        """Return (number of coins, number of size differences), as count_coins does."""
+        return self.num_coins, self.size_differences(size_threshold)
+
+    def size_classes(self, size_threshold=50):
+        """Group the coins into size classes (see cluster_coin_sizes)."""
+        return cluster_coin_sizes(self.areas, size_threshold)
+
+    def coins(self):
+        """
+        Return the region table as JSON-serializable rows.
+
+        Returns:
+        list: One dict per coin with its 'label', 'area', bounding box
+              ('bbox' as [top, left, bottom, right], exclusive), 'centroid'
+              ([row, col]) and 'equivalent_diameter'
+        """
+        present = np.flatnonzero(self.areas)
+        centroids = np.round(self.centroids[present], 2).tolist()
+        diameters = np.round(self.equivalent_diameters[present], 2).tolist()
+        return [{"label": int(index) + 1,
+                 "area": area,
+                 "bbox": bbox,
+                 "centroid": centroid,
+                 "equivalent_diameter": diameter}
+                for index, area, bbox, centroid, diameter in zip(present, self.areas[present].tolist(),
+                                                                 self.bboxes[present].tolist(),
+                                                                 centroids, diameters)]
+
+def label_coins(binary_array):
+    """
+    Label the coins of a boolean mask once and measure them.
+
+    Returns:
+    CoinRegions: The labels and the per-coin region table
+    """
+    labeled_array, num_coins = ndi.label(np.asarray(binary_array))
+    return CoinRegions(labeled_array, num_coins)
 
 def visualize_coins(original_image, processed_image, labeled_image=None, title="Coin Detection"):
     """
@@ -103,6 +247,6 @@ def create_labeled_visualization(binary_image):
         binary_array = binary_image
         
     # Label connected components
-    labeled_array, _ = ndi.label(binary_array)
+    labeled_array, num_labels = ndi.label(binary_array)
     
-    return labeled_array
\ No newline at end of file
+    return _compact_labels(labeled_array, num_labels)
\ No newline at end of file
@@ -1,18 +1,28 @@
 """
 Evaluation module for the coin counter application.
+
+pandas and matplotlib are imported by the functions that use them, so worker
+processes that only count coins do not load them.
 """
 import os
-import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import repeat
 from PIL import Image
 import numpy as np
 
-from coin_counter.preprocessing import preprocess_image
-from coin_counter.segmentation import segment_coins, erode, dilate, filter_coins
-from coin_counter.counting import count_coins
+from pipeline import run_pipeline, DEFAULT_PARAMS
+from preprocessing import image_histogram
+from cache import make_cache_key, make_packed_cache_key, file_digest
+from loader import load_image, load_reduced_gray, prefetch_images
+from batch import count_coins_stack
+from packed import PackedDataset
+from report import (REPORT_STAGES, render_diagnostic, diagnostic_title, render_report, write_html_report,
+                    sheet_filename)
+import instrumentation
 
-def plot_histogram(image, axes, title="Histogram"):
+def plot_histogram(image, axes, title="Histogram", histogram=None):
     """
     Plot a histogram on the given axes.
     
@@ -20,18 +30,20 @@ def plot_histogram(image, axes, title="Histogram"):
         image: The image to process, as a NumPy array.
         axes: The matplotlib axes on which to plot the histogram.
         title: The title of the histogram.
+        histogram: The 256-bin histogram of the image, if already computed.
     """
-    # Convert the image to a 1D array
-    image_array = np.array(image).flatten()
+    # Count the pixel values over all channels
+    if histogram is None:
+        histogram = image_histogram(np.array(image))
 
     # Plot the histogram on the given axes
-    axes.hist(image_array, bins=256, range=(0, 255), color='gray', alpha=0.7, density=False)
+    axes.stairs(histogram, np.arange(257), fill=True, color='gray', alpha=0.7)
     axes.set_title(title)
     axes.set_xlabel('Pixel Value')
     axes.set_ylabel('Frequency')
     axes.grid(axis='y', linestyle='--', alpha=0.6)  # Add a light grid
 
-def evaluate_image(image_path, true_count=None, scale=2):
+def evaluate_image(image_path, true_count=None, scale=2, threshold_method='otsu', output_path=None):
     """
     Evaluate a single image and display the processing steps and results.
     
@@ -39,6 +51,10 @@ def evaluate_image(image_path, true_count=None, scale=2):
     image_path: Path to the image file
     true_count: Actual number of coins in the image (if known)
     scale: Scale factor for image resizing
+    threshold_method: 'otsu' or 'adaptive' (see segment_coins)
+    output_path: If given, the processing steps are saved to this image file
+                 (see render_diagnostic) instead of being displayed, so no
+                 display or matplotlib is needed
     
     Returns:
     dict: Dictionary containing evaluation results
@@ -46,19 +62,40 @@ def evaluate_image(image_path, true_count=None, scale=2):
     # Load the image
     original_image = Image.open(image_path)
     
-    # Preprocess the image
-    gray_image = preprocess_image(original_image, scale)
+    # Run the pipeline once, keeping the intermediate images for display
+    stages = run_pipeline(original_image, REPORT_STAGES, arrays=output_path is not None,
+                          scale=scale, threshold_method=threshold_method)
+    predicted_count, size_differences = stages['count']
+    result_title = diagnostic_title(os.path.basename(image_path), predicted_count, true_count)
+    
+    if output_path is not None:
+        render_diagnostic(original_image, stages, result_title).save(output_path)
+    else:
+        _show_diagnostic(original_image, stages, result_title)
     
-    # Segment the image
-    segmented_image = segment_coins(gray_image)
+    # Return evaluation results
+    results = {
+        "image_name": os.path.basename(image_path),
+        "predicted_count": predicted_count,
+        "size_differences": size_differences
+    }
     
-    # Filter the segmented image
-    eroded_image = erode(segmented_image)
-    dilated_image = dilate(eroded_image, 1)
-    filtered_image = filter_coins(segmented_image)
+    if true_count is not None:
+        results["true_count"] = true_count
+        results["correct"] = predicted_count == true_count
     
-    # Count the coins
-    predicted_count, size_differences = count_coins(filtered_image)
+    return results
+
+def _show_diagnostic(original_image, stages, result_title):
+    """Display the processing steps of evaluate_image in a matplotlib window."""
+    import matplotlib.pyplot as plt
+    import matplotlib.gridspec as gridspec
+    
+    gray_image = stages['preprocessed']
+    segmented_image = stages['segmented']
+    eroded_image = stages['eroded']
+    dilated_image = stages['dilated']
+    filtered_image = stages['filtered']
     
     # Create visualization
     fig = plt.figure(figsize=(18, 15))
@@ -98,7 +135,8 @@ def evaluate_image(image_path, true_count=None, scale=2):
 
     # Second row: histograms
     plot_histogram(original_image, hist_axes1, title="Histogram of Original Image")
-    plot_histogram(gray_image, hist_axes2, title="Histogram of Preprocessed Image")
+    plot_histogram(gray_image, hist_axes2, title="Histogram of Preprocessed Image",
+                   histogram=stages['histogram'])
 
     # Third row: segmentation steps
     axes5.imshow(segmented_image, cmap='gray')
@@ -115,36 +153,215 @@ def evaluate_image(image_path, true_count=None, scale=2):
         ax.axis('off')
 
     # Add a title with the results
-    result_title = f"Image: {os.path.basename(image_path)}, Predicted Count: {predicted_count}"
-    if true_count is not None:
-        result_title += f", Actual Count: {true_count}"
-        result_title += f", {'Correct' if predicted_count == true_count else 'Incorrect'}"
-    
     plt.suptitle(result_title)
     plt.tight_layout()
     plt.show()
+
+# How images are decoded: 'full' decodes at native resolution, 'reduced'
+# decodes directly at 1/scale size and 'gray' also decodes straight to grayscale
+DECODE_MODES = ('full', 'reduced', 'gray')
+
+def _image_loader(scale, decode='full'):
+    """Return the function that loads an image for the given decode mode."""
+    if decode == 'full':
+        return load_image
+    return partial(load_reduced_gray, scale=scale, grayscale=decode == 'gray')
+
+def _count_image(image_path, scale, original_image=None, decode='full', threshold_method='otsu'):
+    """
+    Load an image, unless it is already loaded, and count its coins.
+
+    Runs in a worker process when batch_evaluate is parallel, so errors are
+    returned as messages instead of being raised.
+
+    Parameters:
+    original_image: The image as loaded by _image_loader(scale, decode), if already loaded
+
+    Returns:
+    tuple: ((predicted count, size differences), None) or (None, error message)
+    """
+    try:
+        # Load and process the image
+        if original_image is None:
+            original_image = _image_loader(scale, decode)(image_path)
+        print(f"Processing image: {os.path.basename(image_path)}")
+        
+        # Count the coins
+        if decode == 'full':
+            return run_pipeline(original_image, ('count',), scale=scale,
+                                threshold_method=threshold_method)['count'], None
+        # Reduced decodes already are the pipeline's grayscale stage
+        return run_pipeline(None, ('count',), {'gray': original_image}, scale=scale,
+                            threshold_method=threshold_method)['count'], None
+    except Exception as e:
+        return None, str(e)
+
+def _count_image_in_worker(image_path, scale, decode='full', threshold_method='otsu'):
+    """Run _count_image in a worker process and return its stage statistics with the outcome."""
+    instrumentation.reset()
+    outcome = _count_image(image_path, scale, decode=decode, threshold_method=threshold_method)
+    return outcome, instrumentation.snapshot()
+
+def _count_stacked(loaded, scale, stack_size):
+    """
+    Count the coins in consecutive runs of up to stack_size same-size images at once.
+
+    Parameters:
+    loaded: Iterable of (image_path, image, error) tuples, as from prefetch_images
+
+    Yields:
+    tuple: The outcome of _count_image for each image, in order
+    """
+    group = []
+
+    def flush():
+        images = [image for _, image in group]
+        try:
+            for image_path, _ in group:
+                print(f"Processing image: {os.path.basename(image_path)}")
+            outcomes = [(counts, None) for counts in count_coins_stack(images, scale)]
+        except Exception:
+            # Fall back to one image at a time so only the failing image reports an error
+            outcomes = [_count_image(image_path, scale, image) for image_path, image in group]
+        group.clear()
+        return outcomes
+
+    for image_path, image, error in loaded:
+        if error is not None:
+            yield from flush()
+            yield None, str(error)
+            continue
+        if group and (len(group) == stack_size or
+                      (group[0][1].size, group[0][1].mode) != (image.size, image.mode)):
+            yield from flush()
+        group.append((image_path, image))
+    yield from flush()
+
+def _load_images(image_paths):
+    """Load each image in turn, yielding (image_path, image, error) like prefetch_images."""
+    for image_path in image_paths:
+        try:
+            yield image_path, load_image(image_path), None
+        except Exception as e:
+            yield image_path, None, e
+
+def _count_images(image_paths, scale, workers=1, prefetch=4, prefetch_bytes=512 * 1024 * 1024,
+                  stack_size=1, decode='full', threshold_method='otsu'):
+    """
+    Count the coins in each image, in the order given.
     
-    # Return evaluation results
-    results = {
-        "image_name": os.path.basename(image_path),
-        "predicted_count": predicted_count,
-        "size_differences": size_differences
-    }
+    Images are spread over a process pool if workers > 1, and otherwise
+    prefetched on background threads if prefetch > 0. In a serial run with
+    stack_size > 1, full decoding and Otsu thresholding, consecutive images
+    of the same size are processed as one stack (see count_coins_stack).
     
-    if true_count is not None:
-        results["true_count"] = true_count
-        results["correct"] = predicted_count == true_count
+    Yields:
+    tuple: The outcome of _count_image for each image
+    """
+    if workers <= 1 and stack_size > 1 and decode == 'full' and threshold_method == 'otsu':
+        loaded = (prefetch_images(image_paths, prefetch, prefetch_bytes) if prefetch > 0
+                  else _load_images(image_paths))
+        yield from _count_stacked(loaded, scale, stack_size)
+    elif workers > 1:
+        # executor.map returns the outcomes in submission order
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for outcome, stage_stats in executor.map(_count_image_in_worker, image_paths, repeat(scale),
+                                                     repeat(decode), repeat(threshold_method)):
+                instrumentation.merge(stage_stats)
+                yield outcome
+    elif prefetch > 0:
+        loaded = prefetch_images(image_paths, prefetch, prefetch_bytes, loader=_image_loader(scale, decode))
+        for image_path, image, error in loaded:
+            yield (_count_image(image_path, scale, image, decode, threshold_method) if error is None
+                   else (None, str(error)))
+    else:
+        for image_path in image_paths:
+            yield _count_image(image_path, scale, decode=decode, threshold_method=threshold_method)
+
+def _count_packed_image(packed, index, scale, threshold_method='otsu'):
+    """Count the coins in a preprocessed image of a packed dataset, like _count_image."""
+    try:
+        print(f"Processing image: {packed.entries[index]['image_name']}")
+        results = {'preprocessed': packed.image(index)}
+        return run_pipeline(None, ('count',), results, scale=scale,
+                            threshold_method=threshold_method)['count'], None
+    except Exception as e:
+        return None, str(e)
+
+def _count_packed_in_worker(packed_path, indices, scale, threshold_method='otsu'):
+    """Count the coins of some packed images in a worker process, with its stage statistics."""
+    instrumentation.reset()
+    packed = PackedDataset(packed_path)
+    outcomes = [_count_packed_image(packed, index, scale, threshold_method) for index in indices]
+    return outcomes, instrumentation.snapshot()
+
+def _count_packed(packed, indices, scale, workers=1, threshold_method='otsu'):
+    """
+    Count the coins in the given images of a packed dataset, in order.
+
+    Yields:
+    tuple: The outcome of _count_image for each image
+    """
+    if workers > 1:
+        # Each worker maps the file itself; hand out the images in chunks
+        chunk_size = max(1, len(indices) // (workers * 4))
+        chunks = [indices[start:start + chunk_size] for start in range(0, len(indices), chunk_size)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for outcomes, stage_stats in executor.map(_count_packed_in_worker, repeat(packed.path),
+                                                      chunks, repeat(scale), repeat(threshold_method)):
+                instrumentation.merge(stage_stats)
+                yield from outcomes
+    else:
+        for index in indices:
+            yield _count_packed_image(packed, index, scale, threshold_method)
+
+def load_ground_truth(dataset_path, csv_path):
+    """
+    Read the ground truth CSV (columns folder, image_name and coins_count).
+
+    Returns:
+    list: (image name, true count, image path) for each row
+    """
+    import pandas as pd
     
-    return results
+    truth_data = pd.read_csv(csv_path)
+    return [(row['image_name'], row['coins_count'],
+             os.path.join(dataset_path, row['folder'], row['image_name']))
+            for _, row in truth_data.iterrows()]
 
-def batch_evaluate(dataset_path, csv_path, output_folder="correct_images"):
+def batch_evaluate(dataset_path, csv_path, output_folder="correct_images", workers=1,
+                   prefetch=4, prefetch_bytes=512 * 1024 * 1024, cache=None, stack_size=1,
+                   packed=None, report_dir=None, threshold_method='otsu', decode='full'):
     """
     Evaluate multiple images and calculate accuracy metrics.
     
     Parameters:
-    dataset_path: Path to the dataset folder
+    dataset_path: Path to the dataset folder (None with packed: correct
+                  images are then not copied)
     csv_path: Path to the CSV file with ground truth data
     output_folder: Folder to save correctly evaluated images
+    workers: Number of worker processes used to process images in parallel
+    prefetch: Number of images decoded ahead on background threads in a
+              serial run (0 decodes each image right before processing it)
+    prefetch_bytes: Memory cap for the prefetched images
+    cache: Optional ResultCache; images whose content and parameters are
+           unchanged since a previous run are not processed again (with
+           packed, images are identified by the packed file's content)
+    stack_size: Maximum number of consecutive same-size images processed
+                together in one stacked call in a serial run (1 disables stacking)
+    packed: Optional PackedDataset or path of a file written by pack_dataset;
+            the images and ground truth are then read from it instead of
+            being decoded and preprocessed, and its scale is used (csv_path
+            is not read, and dataset_path is only used to copy correct images)
+    report_dir: If given, a diagnostic sheet of every image is rendered there
+                (in parallel with workers > 1) and linked from report_dir/index.html;
+                the images are then decoded from dataset_path even with packed,
+                and the cache is not used
+    threshold_method: 'otsu' or 'adaptive' (see segment_coins); images are
+                      only stacked with 'otsu'
+    decode: 'full' (default), 'reduced' to decode images directly at the
+            reduced size, or 'gray' to also decode straight to grayscale
+            (see load_reduced_gray); not used with packed or report_dir
     
     Returns:
     dict: Dictionary containing evaluation metrics
@@ -153,38 +370,72 @@ def batch_evaluate(dataset_path, csv_path, output_folder="correct_images"):
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
     
-    # Load ground truth data
-    truth_data = pd.read_csv(csv_path)
-    
     results = []
+    errors = []
     total_images = 0
     total_errors = 0
     scale = 8  # Scale factor for image preprocessing
     
-    # Process each image in the dataset
-    for _, row in truth_data.iterrows():
-        folder = row['folder']
-        image_name = row['image_name']
-        true_count = row['coins_count']
+    # Load ground truth data
+    if packed is not None:
+        if not isinstance(packed, PackedDataset):
+            packed = PackedDataset(packed)
+        rows = packed.rows(dataset_path or '')
+        scale = packed.scale
+    else:
+        rows = load_ground_truth(dataset_path, csv_path)
+    
+    image_paths = [image_path for _, _, image_path in rows]
+    
+    # Look up the images already processed with the same parameters
+    keys = [None] * len(rows)
+    cached = {}
+    if cache is not None and report_dir is None:
+        params = {**DEFAULT_PARAMS, 'scale': scale, 'threshold_method': threshold_method}
+        if decode != 'full' and packed is None:
+            params['decode'] = decode
+        # Packed images are identified by the packed file, which holds their pixels
+        packed_digest = file_digest(packed.path) if packed is not None else None
+        for index, image_path in enumerate(image_paths):
+            try:
+                if packed_digest is not None:
+                    entry = packed.entries[index]
+                    keys[index] = make_packed_cache_key(packed_digest, f"{entry['folder']}/{entry['image_name']}",
+                                                        params)
+                else:
+                    keys[index] = make_cache_key(image_path, params)
+            except OSError:
+                continue  # Unreadable images are reported when they are processed
+            counts = cache.get(keys[index])
+            if counts is not None:
+                cached[index] = counts
+    
+    # Count the coins in the remaining images
+    missing = [index for index in range(len(rows)) if index not in cached]
+    if report_dir is not None:
+        computed = render_report([rows[index] for index in missing], report_dir, scale, threshold_method,
+                                 workers, prefetch, prefetch_bytes)
+    elif packed is not None:
+        computed = _count_packed(packed, missing, scale, workers, threshold_method)
+    else:
+        computed = _count_images([image_paths[index] for index in missing], scale,
+                                 workers, prefetch, prefetch_bytes, stack_size, decode, threshold_method)
+    
+    for index, (image_name, true_count, image_path) in enumerate(rows):
+        if index in cached:
+            counts, error = cached[index], None
+        else:
+            counts, error = next(computed)
+            if error is None and keys[index] is not None:
+                cache.put(keys[index], counts)
         
-        image_path = os.path.join(dataset_path, folder, image_name)
+        if error is not None:
+            print(f"Error processing {image_name}: {error}")
+            errors.append((image_name, error))
+            continue
         
         try:
-            # Load and process the image
-            original_image = Image.open(image_path)
-            print(f"Processing image: {image_name}")
-            
-            # Preprocess the image
-            preprocessed_image = preprocess_image(original_image, scale)
-            
-            # Segment the image
-            segmented_image = segment_coins(preprocessed_image)
-            
-            # Filter the segmented image
-            filtered_image = filter_coins(segmented_image)
-            
-            # Count the coins
-            predicted_count, size_differences = count_coins(filtered_image)
+            predicted_count, size_differences = counts
             
             # Record the results
             total_images += 1
@@ -192,7 +443,7 @@ def batch_evaluate(dataset_path, csv_path, output_folder="correct_images"):
             
             if is_error:
                 total_errors += 1
-            else:
+            elif dataset_path is not None:
                 # Save correctly evaluated images
                 import shutil
                 correct_image_path = os.path.join(output_folder, image_name)
@@ -206,6 +457,8 @@ def batch_evaluate(dataset_path, csv_path, output_folder="correct_images"):
                 "correct": not is_error,
                 "size_differences": size_differences
             })
+            if report_dir is not None:
+                results[-1]["report"] = sheet_filename(index, image_name)
             
         except Exception as e:
             print(f"Error processing {image_name}: {e}")
@@ -220,13 +473,100 @@ def batch_evaluate(dataset_path, csv_path, output_folder="correct_images"):
           f"Accuracy: {accuracy:.2f}%")
     
     # Save detailed results to CSV
+    import pandas as pd
     results_df = pd.DataFrame(results)
     results_df.to_csv("evaluation_results.csv", index=False)
     print("Detailed results saved to evaluation_results.csv")
     
+    if report_dir is not None:
+        index_path = write_html_report(results, report_dir, accuracy, errors)
+        print(f"Report saved to {index_path}")
+    
     return {
         "results": results,
         "total_images": total_images,
         "total_errors": total_errors,
         "accuracy": accuracy
-    }
\ No newline at end of file
+    }
+
+def compare_decode_modes(dataset_path, csv_path, scale=8, modes=DECODE_MODES,
+                         output_csv="decode_comparison.csv"):
+    """
+    Compare the accuracy and speed of the decode modes on a dataset.
+    
+    Every image is counted once per mode, serially, timing its decoding and
+    counting together. The first mode is the reference the others are
+    compared with.
+    
+    Parameters:
+    dataset_path: Path to the dataset folder
+    csv_path: Path to the CSV file with ground truth data
+    scale: Scale factor for image resizing
+    modes: Decode modes to compare (see DECODE_MODES)
+    output_csv: Where to save the per-image counts (None to skip)
+    
+    Returns:
+    list: One dict per mode with 'decode', 'images', 'accuracy' (percent),
+          'mean_abs_error', 'agreement' (percent of images counted like the
+          reference mode) and 'ms_per_image'
+    """
+    rows = load_ground_truth(dataset_path, csv_path)
+    counts = {mode: [] for mode in modes}
+    seconds = dict.fromkeys(modes, 0.0)
+    per_image = []
+    
+    for image_name, true_count, image_path in rows:
+        try:
+            # Read the file once so no mode pays for a cold disk read
+            with open(image_path, 'rb') as f:
+                f.read()
+        except OSError as e:
+            print(f"Error processing {image_name}: {e}")
+            continue
+        
+        outcomes = {}
+        for mode in modes:
+            start = time.perf_counter()
+            outcome, error = _count_image(image_path, scale, decode=mode)
+            elapsed = time.perf_counter() - start
+            if error is not None:
+                print(f"Error processing {image_name} ({mode}): {error}")
+                break
+            outcomes[mode] = (outcome[0], elapsed)
+        if len(outcomes) < len(modes):
+            continue
+        
+        row = {"image_name": image_name, "true_count": true_count}
+        for mode, (predicted_count, elapsed) in outcomes.items():
+            counts[mode].append((predicted_count, true_count))
+            seconds[mode] += elapsed
+            row[f"{mode}_count"] = predicted_count
+        per_image.append(row)
+    
+    reference = [predicted for predicted, _ in counts[modes[0]]]
+    summary = []
+    for mode in modes:
+        images = len(counts[mode])
+        predicted = [predicted_count for predicted_count, _ in counts[mode]]
+        summary.append({
+            "decode": mode,
+            "images": images,
+            "accuracy": 100.0 * sum(p == t for p, t in counts[mode]) / images if images else 0.0,
+            "mean_abs_error": sum(abs(p - t) for p, t in counts[mode]) / images if images else 0.0,
+            "agreement": 100.0 * sum(p == r for p, r in zip(predicted, reference)) / images if images else 0.0,
+            "ms_per_image": 1000 * seconds[mode] / images if images else 0.0,
+        })
+    
+    print(f"\n{'decode':<10}{'images':>8}{'accuracy':>10}{'MAE':>8}{'agree':>8}{'ms/image':>10}{'speed-up':>10}")
+    for result in summary:
+        speedup = summary[0]['ms_per_image'] / result['ms_per_image'] if result['ms_per_image'] > 0 else 0.0
+        print(f"{result['decode']:<10}{result['images']:>8}{result['accuracy']:>9.1f}%"
+              f"{result['mean_abs_error']:>8.2f}{result['agreement']:>7.1f}%"
+              f"{result['ms_per_image']:>10.1f}{speedup:>9.1f}x")
+    
+    if output_csv:
+        import pandas as pd
+        pd.DataFrame(per_image).to_csv(output_csv, index=False)
+        print(f"Per-image counts saved to {output_csv}")
+    
+    return summary
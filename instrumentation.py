@@ -0,0 +1,144 @@
+"""
+Per-stage timing and memory instrumentation for the coin counter application.
+"""
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+# Upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTES_BUCKETS = tuple(2 ** exponent for exponent in range(20, 32, 2))  # 1 MiB to 1 GiB
+
+_lock = threading.Lock()
+_stages = {}  # stage name -> aggregated statistics, see _empty_stats
+
+def _empty_stats():
+    return {
+        'count': 0,
+        'seconds_sum': 0.0,
+        'seconds_buckets': [0] * len(SECONDS_BUCKETS),
+        'peak_bytes_count': 0,
+        'peak_bytes_sum': 0,
+        'peak_bytes_max': 0,
+        'peak_bytes_buckets': [0] * len(BYTES_BUCKETS),
+        'input_pixels': 0,
+    }
+
+def enable_memory_tracking():
+    """Start tracemalloc so that stages also record their peak allocated memory."""
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def input_pixels(image):
+    """Return the number of pixels of a PIL Image or NumPy array (0 for anything else)."""
+    if hasattr(image, 'size') and isinstance(image.size, tuple):
+        width, height = image.size
+        return width * height
+    if isinstance(image, np.ndarray) and image.ndim >= 2:
+        return image.shape[0] * image.shape[1]
+    return 0
+
+def record(stage, seconds, peak_bytes=None, pixels=0):
+    """Add one measurement of a stage."""
+    with _lock:
+        stats = _stages.setdefault(stage, _empty_stats())
+        stats['count'] += 1
+        stats['seconds_sum'] += seconds
+        stats['input_pixels'] += pixels
+        for index, bound in enumerate(SECONDS_BUCKETS):
+            if seconds <= bound:
+                stats['seconds_buckets'][index] += 1
+        if peak_bytes is not None:
+            stats['peak_bytes_count'] += 1
+            stats['peak_bytes_sum'] += peak_bytes
+            stats['peak_bytes_max'] = max(stats['peak_bytes_max'], peak_bytes)
+            for index, bound in enumerate(BYTES_BUCKETS):
+                if peak_bytes <= bound:
+                    stats['peak_bytes_buckets'][index] += 1
+
+@contextmanager
+def record_stage(stage, pixels=0):
+    """
+    Record the wall time of the enclosed block, and its peak allocated memory
+    if tracemalloc is running.
+    
+    Peak memory is approximate when stages run concurrently in several threads,
+    since tracemalloc keeps a single process-wide peak.
+    """
+    tracking = tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak')
+    if tracking:
+        start_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        peak_bytes = max(0, tracemalloc.get_traced_memory()[1] - start_bytes) if tracking else None
+        record(stage, seconds, peak_bytes, pixels)
+
+def snapshot():
+    """Return a copy of the statistics, e.g. to send them from a worker process."""
+    with _lock:
+        return {stage: {key: list(value) if isinstance(value, list) else value
+                        for key, value in stats.items()}
+                for stage, stats in _stages.items()}
+
+def merge(other):
+    """Add statistics returned by snapshot() in another process."""
+    with _lock:
+        for stage, other_stats in other.items():
+            stats = _stages.setdefault(stage, _empty_stats())
+            for key, value in other_stats.items():
+                if key == 'peak_bytes_max':
+                    stats[key] = max(stats[key], value)
+                elif isinstance(value, list):
+                    stats[key] = [a + b for a, b in zip(stats[key], value)]
+                else:
+                    stats[key] += value
+
+def reset():
+    """Discard all recorded statistics."""
+    with _lock:
+        _stages.clear()
+
+def render_prometheus(prefix='coin_counter'):
+    """Render the statistics as Prometheus text-format histograms."""
+    stats_by_stage = snapshot()
+    lines = []
+    
+    def histogram(name, help_text, buckets, buckets_key, sum_key, count_key):
+        lines.append(f"# HELP {prefix}_{name} {help_text}")
+        lines.append(f"# TYPE {prefix}_{name} histogram")
+        for stage, stats in sorted(stats_by_stage.items()):
+            for bound, bucket_count in zip(buckets, stats[buckets_key]):
+                lines.append(f'{prefix}_{name}_bucket{{stage="{stage}",le="{bound}"}} {bucket_count}')
+            lines.append(f'{prefix}_{name}_bucket{{stage="{stage}",le="+Inf"}} {stats[count_key]}')
+            lines.append(f'{prefix}_{name}_sum{{stage="{stage}"}} {stats[sum_key]}')
+            lines.append(f'{prefix}_{name}_count{{stage="{stage}"}} {stats[count_key]}')
+    
+    histogram('stage_seconds', 'Wall time per pipeline stage.', SECONDS_BUCKETS,
+              'seconds_buckets', 'seconds_sum', 'count')
+    histogram('stage_peak_bytes', 'Peak allocated memory per pipeline stage.', BYTES_BUCKETS,
+              'peak_bytes_buckets', 'peak_bytes_sum', 'peak_bytes_count')
+    
+    lines.append(f"# HELP {prefix}_stage_input_pixels_total Input pixels processed per pipeline stage.")
+    lines.append(f"# TYPE {prefix}_stage_input_pixels_total counter")
+    for stage, stats in sorted(stats_by_stage.items()):
+        lines.append(f'{prefix}_stage_input_pixels_total{{stage="{stage}"}} {stats["input_pixels"]}')
+    return "\n".join(lines) + "\n"
+
+def format_breakdown():
+    """Format the statistics as a per-stage table."""
+    stats_by_stage = snapshot()
+    total = sum(stats['seconds_sum'] for stats in stats_by_stage.values()) or 1.0
+    lines = [f"{'stage':<16}{'calls':>7}{'total ms':>11}{'mean ms':>10}{'share':>8}{'peak MB':>10}{'MPix':>9}"]
+    for stage, stats in sorted(stats_by_stage.items(), key=lambda item: -item[1]['seconds_sum']):
+        peak = f"{stats['peak_bytes_max'] / 2 ** 20:.1f}" if stats['peak_bytes_count'] else "-"
+        lines.append(f"{stage:<16}{stats['count']:>7}{stats['seconds_sum'] * 1000:>11.1f}"
+                     f"{stats['seconds_sum'] * 1000 / stats['count']:>10.2f}"
+                     f"{stats['seconds_sum'] / total:>8.0%}{peak:>10}{stats['input_pixels'] / 1e6:>9.2f}")
+    return "\n".join(lines)
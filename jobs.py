@@ -0,0 +1,80 @@
+"""
+Background job queue for the coin counter web application.
+"""
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the queue is full."""
+
+class JobQueue:
+    """
+    Bounded pool of worker threads that runs jobs in the background.
+
+    At most max_pending jobs may be queued or running at once; submitting
+    another one raises QueueFullError instead of blocking. The results of
+    the last max_finished completed jobs are kept for retrieval.
+    """
+
+    def __init__(self, workers=2, max_pending=8, max_finished=256):
+        self.max_finished = max_finished
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='coin-job')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._jobs = OrderedDict()  # job id -> Future, oldest first
+        self._lock = threading.Lock()
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queue a job.
+
+        Returns:
+        str: The job id
+
+        Raises:
+        QueueFullError: If max_pending jobs are already queued or running
+        """
+        if not self._slots.acquire(blocking=False):
+            raise QueueFullError("Job queue is full")
+
+        job_id = uuid.uuid4().hex
+        try:
+            future = self._executor.submit(function, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+
+        with self._lock:
+            self._jobs[job_id] = future
+            self._prune()
+        return job_id
+
+    def _prune(self):
+        """Forget the oldest finished jobs beyond max_finished."""
+        finished = [job_id for job_id, future in self._jobs.items() if future.done()]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
+
+    def status(self, job_id):
+        """Return 'queued', 'running', 'done' or 'failed', or None for an unknown job."""
+        with self._lock:
+            future = self._jobs.get(job_id)
+        if future is None:
+            return None
+        if future.running():
+            return 'running'
+        if not future.done():
+            return 'queued'
+        return 'failed' if future.exception() is not None else 'done'
+
+    def result(self, job_id):
+        """
+        Return the result of a finished job.
+
+        Raises the job's exception if it failed, and KeyError for an unknown job.
+        """
+        with self._lock:
+            future = self._jobs[job_id]
+        return future.result()
@@ -0,0 +1,128 @@
+"""
+Image loading module for the coin counter application.
+"""
+import glob
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+from preprocessing import grayscale_array
+from instrumentation import record_stage, input_pixels
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tif', '.tiff')
+
+def load_image(image_path):
+    """Open an image from a path or file object and decode its pixel data."""
+    image = Image.open(image_path)
+    with record_stage('decode', input_pixels(image)):
+        image.load()
+    return image
+
+def load_reduced_gray(image_path, scale=2, grayscale=False):
+    """
+    Decode an image directly at 1/scale size and return the pipeline's 'gray' stage.
+
+    JPEG files are decoded at 1/2, 1/4 or 1/8 size with the decoder's DCT
+    scaling (draft mode), the rest of the way is an integer reduce(), and
+    only a final resize of at most about 2x uses the LANCZOS filter, so most
+    of the full-size pixels are never decoded. The result is not identical
+    to resizing the full decode, so counts can change (see
+    compare_decode_modes).
+
+    Parameters:
+    image_path: Path to the image file
+    scale: Scale factor for image resizing, as for convert_to_grayscale
+    grayscale: Decode straight to grayscale (for JPEG, only the luma
+               channel is decoded); luma weights the channels instead of
+               averaging their uint8 sum, so counts may differ slightly
+
+    Returns:
+    numpy.ndarray: uint8 grayscale array of the size convert_to_grayscale produces
+    """
+    image = Image.open(image_path)
+    width, height = image.width // scale, image.height // scale
+    with record_stage('decode', input_pixels(image)):
+        image.draft('L' if grayscale else None, (width, height))
+        image.load()
+        # Leave a factor of about 2 for the LANCZOS filter
+        factor = min(image.width // width, image.height // height) // 2
+        if factor >= 2:
+            image = image.reduce(factor)
+        image = image.resize((width, height), Image.Resampling.LANCZOS)
+    if grayscale:
+        return np.asarray(image.convert('L'))
+    return grayscale_array(np.asarray(image))
+
+def estimate_decoded_size(image_path):
+    """Estimate the decoded size of an image in bytes by reading only its header."""
+    try:
+        with Image.open(image_path) as image:
+            width, height = image.size
+            return width * height * len(image.getbands())
+    except Exception:
+        # Unreadable files fail later, when they are decoded
+        return 0
+
+def expand_image_paths(pattern):
+    """
+    List the image files in a directory, or matching a glob pattern.
+
+    Parameters:
+    pattern: Directory path or glob pattern
+
+    Returns:
+    list: Sorted image file paths
+    """
+    if os.path.isdir(pattern):
+        paths = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+    else:
+        paths = glob.glob(pattern)
+    return sorted(path for path in paths
+                  if os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS))
+
+def prefetch_images(image_paths, depth=4, max_bytes=512 * 1024 * 1024, threads=2, loader=load_image):
+    """
+    Load images in order while decoding the upcoming ones on background threads.
+
+    At most `depth` images are queued ahead of the consumer, and no new image
+    is queued if the estimated decoded size of the queue would exceed
+    max_bytes (a single image is always allowed, however large).
+
+    Parameters:
+    image_paths: Paths of the images to load
+    depth: Maximum number of images decoded ahead
+    max_bytes: Memory cap for the decoded images waiting in the queue
+    threads: Number of decoding threads
+    loader: Function that loads one image from its path
+
+    Yields:
+    tuple: (image_path, image, error) where either image or error is None
+    """
+    image_paths = list(image_paths)
+    pending = deque()  # (image_path, estimated size, future)
+    queued_bytes = 0
+    next_index = 0
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        while pending or next_index < len(image_paths):
+            # Fill the queue up to the depth and memory limits
+            while next_index < len(image_paths) and len(pending) < max(depth, 1):
+                image_path = image_paths[next_index]
+                size = estimate_decoded_size(image_path)
+                if pending and queued_bytes + size > max_bytes:
+                    break
+                pending.append((image_path, size, executor.submit(loader, image_path)))
+                queued_bytes += size
+                next_index += 1
+
+            # Hand the oldest image to the consumer
+            image_path, size, future = pending.popleft()
+            queued_bytes -= size
+            try:
+                image = future.result()
+            except Exception as e:
+                yield image_path, None, e
+            else:
+                yield image_path, image, None
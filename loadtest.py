@@ -0,0 +1,364 @@
+"""
+Local load test for the coin counter web application.
+
+Posts synthetic or dataset images to /upload (or /api/count) at a chosen
+concurrency and request rate, and reports latency percentiles, throughput,
+error rates and, sampled over time, the server's resident memory and the
+files piling up in its upload folder. Reports can be saved as JSON and
+compared against a previous run.
+
+By default the server is started on a free local port, with one preforked
+pipeline worker per CPU and without the debug server, and stopped
+afterwards; with --url an already running server is tested instead (pass
+--pid to sample its memory).
+
+Usage:
+    python loadtest.py --requests 200 --concurrency 8 --workers 0 --save-report threads.json
+    python loadtest.py --requests 200 --concurrency 8 --workers 4 --baseline threads.json
+    python loadtest.py --url http://127.0.0.1:5000 --pid 12345 --rate 20 --duration 60
+"""
+import argparse
+import io
+import json
+import os
+import queue
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+import numpy as np
+
+from benchmark import generate_coin_image, parse_size
+from loader import expand_image_paths
+
+_REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+UPLOAD_FOLDER = os.path.join(_REPO_DIR, 'uploads')
+
+def synthetic_images(sizes, count=4, num_coins=12, seed=0):
+    """Return (filename, JPEG bytes) for count synthetic coin images of each size."""
+    images = []
+    for width, height in sizes:
+        radius = min(width, height) / (4 * np.sqrt(num_coins))
+        for index in range(count):
+            image = generate_coin_image(width, height, num_coins, (0.6 * radius, radius), seed=seed + index)
+            encoded = io.BytesIO()
+            image.save(encoded, format="JPEG", quality=90)
+            images.append((f"synthetic_{width}x{height}_{index}.jpg", encoded.getvalue()))
+    return images
+
+def dataset_images(pattern):
+    """Return (filename, file bytes) for every image in a directory or matching a glob pattern."""
+    images = []
+    for path in expand_image_paths(pattern):
+        with open(path, 'rb') as f:
+            images.append((os.path.basename(path), f.read()))
+    return images
+
+def encode_multipart(fields, filename, data):
+    """
+    Encode form fields and one 'file' part as multipart/form-data.
+
+    Returns:
+    tuple: (body bytes, Content-Type header)
+    """
+    boundary = uuid.uuid4().hex
+    parts = [f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode('utf-8')
+             for name, value in fields.items()]
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n'.encode('utf-8') + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode('utf-8'))
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+def post_image(url, filename, data, fields, timeout=60):
+    """
+    Post one image and read the whole response.
+
+    Returns:
+    int: HTTP status, or 0 if the request failed without a response
+    """
+    body, content_type = encode_multipart(fields, filename, data)
+    request = urllib.request.Request(url, body, {'Content-Type': content_type})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        return e.code
+    except (urllib.error.URLError, OSError):
+        return 0
+
+def process_tree_rss(pid):
+    """Return the resident memory in bytes of a process and all its descendants (Linux /proc), or None."""
+    total = 0
+    pending = [pid]
+    try:
+        while pending:
+            current = pending.pop()
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children') as f:
+                    pending.extend(int(child) for child in f.read().split())
+    except (OSError, ValueError):
+        return total or None
+    return total
+
+def folder_usage(folder):
+    """Return (number of files, total bytes) in a folder, or (0, 0) if it does not exist."""
+    try:
+        entries = [entry for entry in os.scandir(folder) if entry.is_file()]
+    except OSError:
+        return 0, 0
+    return len(entries), sum(entry.stat().st_size for entry in entries)
+
+def _free_port():
+    """Return a free local TCP port."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_server(workers=0, max_concurrent=None, port=None, timeout=60):
+    """
+    Start web_app.py in a subprocess and wait until it answers.
+
+    The debug server and its reloader are never used, so the numbers match
+    a production run: workers=0 processes images in the request threads.
+
+    Returns:
+    tuple: (Popen, base URL)
+    """
+    port = port or _free_port()
+    command = [sys.executable, os.path.join(_REPO_DIR, 'web_app.py'), '--port', str(port),
+               '--workers', str(workers), '--no-debug']
+    if max_concurrent:
+        command += ['--max-concurrent', str(max_concurrent)]
+    # A session of its own, so the server can be stopped with its worker processes
+    server = subprocess.Popen(command, cwd=_REPO_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                              start_new_session=True)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with status {server.returncode}")
+        try:
+            with urllib.request.urlopen(url + '/', timeout=1) as response:
+                response.read()
+            return server, url
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.2)
+    stop_server(server)
+    raise RuntimeError("Server did not start in time")
+
+def stop_server(server):
+    """Stop a server started by start_server, with every process it started."""
+    try:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        os.killpg(server.pid, signal.SIGKILL)
+        server.wait()
+    except ProcessLookupError:
+        pass
+
+def run_load(url, images, concurrency=4, rate=0.0, requests=100, duration=None, fields=None,
+             pid=None, upload_folder=UPLOAD_FOLDER, sample_interval=1.0):
+    """
+    Send images to url and measure the responses.
+
+    Parameters:
+    url: Full URL of the endpoint
+    images: (filename, bytes) pairs, sent in turn
+    concurrency: Number of requests in flight at once
+    rate: Requests per second to start (0 sends as fast as the concurrency allows).
+          With a rate, latency is measured from each request's scheduled start, so
+          time spent waiting for a free connection counts
+    requests: Number of requests to send (ignored if duration is given)
+    duration: Seconds to keep sending requests
+    fields: Extra form fields sent with each image
+    pid: Server process whose memory (with its children) is sampled
+    upload_folder: Folder whose file count and size are sampled
+    sample_interval: Seconds between samples
+
+    Returns:
+    dict: 'latencies' (seconds of the successful requests), 'statuses'
+          (status -> count, 0 for connection errors), 'elapsed' and
+          'samples' ([seconds, RSS bytes, upload files, upload bytes, completed])
+    """
+    fields = fields or {}
+    latencies, statuses, samples = [], {}, []
+    lock = threading.Lock()
+    completed = [0]
+    jobs = queue.Queue(maxsize=concurrency * 2)
+    start = time.perf_counter()
+    files_before, bytes_before = folder_usage(upload_folder)
+
+    def worker():
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            scheduled, (filename, data) = job
+            begin = scheduled if rate > 0 else time.perf_counter()
+            status = post_image(url, filename, data, fields)
+            latency = time.perf_counter() - begin
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+                if 200 <= status < 400:
+                    latencies.append(latency)
+                completed[0] += 1
+
+    stop_sampling = threading.Event()
+
+    def sampler():
+        while True:
+            # One last sample is taken once the load is over
+            finished = stop_sampling.is_set()
+            files, size = folder_usage(upload_folder)
+            with lock:
+                done = completed[0]
+            samples.append([time.perf_counter() - start, process_tree_rss(pid) if pid else None,
+                            files - files_before, size - bytes_before, done])
+            if finished:
+                return
+            stop_sampling.wait(sample_interval)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    sampling = threading.Thread(target=sampler, daemon=True)
+    sampling.start()
+
+    index = 0
+    while (time.perf_counter() - start < duration) if duration is not None else (index < requests):
+        scheduled = start + index / rate if rate > 0 else time.perf_counter()
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        jobs.put((scheduled, images[index % len(images)]))
+        index += 1
+    for _ in threads:
+        jobs.put(None)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    stop_sampling.set()
+    sampling.join()
+    return {'latencies': latencies, 'statuses': statuses, 'elapsed': elapsed, 'samples': samples}
+
+def summarize(result):
+    """
+    Reduce a run_load result to the figures that are compared between runs.
+
+    Returns:
+    dict: requests, ok, error_rate, shed_rate (503s), throughput (successful
+          requests per second), latency percentiles in ms, peak_rss_mb and
+          upload_files / upload_mb left in the upload folder
+    """
+    statuses = result['statuses']
+    total = sum(statuses.values())
+    ok = sum(count for status, count in statuses.items() if 200 <= status < 400)
+    latencies = np.array(result['latencies']) * 1000
+    percentiles = (dict(zip(('p50_ms', 'p90_ms', 'p99_ms'), np.percentile(latencies, [50, 90, 99]).tolist()),
+                        max_ms=float(latencies.max()))
+                   if latencies.size else dict.fromkeys(('p50_ms', 'p90_ms', 'p99_ms', 'max_ms')))
+    rss = [sample[1] for sample in result['samples'] if sample[1] is not None]
+    last = result['samples'][-1] if result['samples'] else [0, None, 0, 0, 0]
+    return {
+        'requests': total,
+        'ok': ok,
+        'error_rate': (total - ok) / total if total else 0.0,
+        'shed_rate': statuses.get(503, 0) / total if total else 0.0,
+        'throughput': ok / result['elapsed'] if result['elapsed'] > 0 else 0.0,
+        **percentiles,
+        'peak_rss_mb': max(rss) / 2 ** 20 if rss else None,
+        'upload_files': last[2],
+        'upload_mb': last[3] / 2 ** 20,
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+    }
+
+def print_report(result, summary, baseline=None):
+    """Print the memory timeline and the summary, with the change against a baseline summary if given."""
+    print(f"{'seconds':>8}{'RSS MB':>10}{'uploads':>9}{'upload MB':>11}{'done':>7}")
+    for seconds, rss, files, size, done in result['samples']:
+        rss_text = f"{rss / 2 ** 20:>10.1f}" if rss is not None else f"{'-':>10}"
+        print(f"{seconds:>8.1f}{rss_text}{files:>9}{size / 2 ** 20:>11.1f}{done:>7}")
+
+    print()
+    for name in ('requests', 'ok', 'error_rate', 'shed_rate', 'throughput', 'p50_ms', 'p90_ms', 'p99_ms',
+                 'max_ms', 'peak_rss_mb', 'upload_files', 'upload_mb'):
+        value = summary[name]
+        line = f"  {name:<14}" + (f"{value:>12.3f}" if isinstance(value, float) else f"{str(value):>12}")
+        reference = (baseline or {}).get(name)
+        if isinstance(value, (int, float)) and isinstance(reference, (int, float)) and reference:
+            line += f"{value / reference:>10.2f}x"
+        print(line)
+    print(f"  {'statuses':<14}{json.dumps(summary['statuses']):>12}")
+
+def main():
+    """Run a load test from the command line."""
+    parser = argparse.ArgumentParser(description='Coin Counter web load test')
+    parser.add_argument('--url', type=str, help='Base URL of a running server (default: start one)')
+    parser.add_argument('--pid', type=int, help='Process id of the running server, to sample its memory')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='--workers of the started server (default: one per CPU, 0 for request threads)')
+    parser.add_argument('--max-concurrent', type=int, help='--max-concurrent of the started server')
+    parser.add_argument('--endpoint', choices=['/upload', '/api/count'], default='/upload',
+                        help='Endpoint to post the images to')
+    parser.add_argument('--images', type=str, help='Directory or glob of images to send (default: synthetic)')
+    parser.add_argument('--sizes', nargs='+', type=parse_size, default=[(1600, 1200)],
+                        help='Sizes of the synthetic images as WIDTHxHEIGHT')
+    parser.add_argument('--distinct', type=int, default=4,
+                        help='Distinct synthetic images per size; the server reuses results of identical images')
+    parser.add_argument('--scale', type=int, default=2, help='Scale factor sent with each image')
+    parser.add_argument('--concurrency', type=int, default=4, help='Requests in flight at once')
+    parser.add_argument('--rate', type=float, default=0.0, help='Requests per second (0 for as fast as possible)')
+    parser.add_argument('--requests', type=int, default=100, help='Number of requests to send')
+    parser.add_argument('--duration', type=float, help='Send requests for this many seconds instead')
+    parser.add_argument('--sample-interval', type=float, default=1.0, help='Seconds between memory samples')
+    parser.add_argument('--upload-folder', type=str, default=UPLOAD_FOLDER, help='Upload folder of the server')
+    parser.add_argument('--baseline', type=str, help='Compare against a report saved with --save-report')
+    parser.add_argument('--save-report', type=str, help='Save the summary as a JSON file')
+    args = parser.parse_args()
+
+    images = dataset_images(args.images) if args.images else synthetic_images(args.sizes, args.distinct)
+    if not images:
+        parser.error(f"No images found for {args.images}")
+
+    server = None
+    if args.url:
+        url, pid = args.url.rstrip('/'), args.pid
+    else:
+        server, url = start_server(args.workers, args.max_concurrent)
+        pid = server.pid
+    try:
+        result = run_load(url + args.endpoint, images, args.concurrency, args.rate, args.requests,
+                          args.duration, {'scale': args.scale}, pid, args.upload_folder, args.sample_interval)
+    finally:
+        if server is not None:
+            stop_server(server)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    summary = summarize(result)
+    print_report(result, summary, baseline)
+
+    if args.save_report:
+        with open(args.save_report, 'w') as f:
+            json.dump(summary, f, indent=2)
+        print(f"\nReport saved to {args.save_report}")
+
+if __name__ == "__main__":
+    main()
@@ -1,91 +1,267 @@
 """
 Main module for the coin counter application.
+
+Only NumPy, SciPy and PIL are imported up front, so counting starts quickly;
+the dataset download, evaluation and plotting modules (kagglehub, pandas,
+matplotlib) are imported by the commands that use them.
 """
 import os
 import argparse
-from PIL import Image
-import kagglehub
 
-from preprocessing import preprocess_image
-from segmentation import segment_coins, filter_coins
-from counting import count_coins, visualize_coins, create_labeled_visualization
-from evaluation import evaluate_image, batch_evaluate
+from pipeline import run_pipeline
+from loader import load_image, expand_image_paths, prefetch_images
+from cache import ResultCache
+from tiling import count_coins_tiled, open_raw_image
+from stream import count_stream
+import instrumentation
+from counting import visualize_coins
 
 def download_dataset():
     """Download the coin dataset from Kaggle."""
+    import kagglehub
+
     print("Downloading dataset from Kaggle...")
     path = kagglehub.dataset_download("balabaskar/count-coins-image-dataset")
     print(f"Dataset downloaded to: {path}")
     return path
 
-def process_single_image(image_path, scale=2, visualize=True):
+def process_single_image(image_path, scale=2, visualize=True, original_image=None, threshold_method='otsu'):
     """
     Process a single image and count the coins.
-    
+
     Parameters:
     image_path: Path to the image file
     scale: Scale factor for image resizing
     visualize: Whether to display visualization
-    
+    original_image: The already loaded image, if any (loaded from image_path otherwise)
+    threshold_method: 'otsu' or 'adaptive' (see segment_coins)
+
     Returns:
     tuple: (number of coins, number of size differences)
     """
     # Load the image
-    original_image = Image.open(image_path)
+    if original_image is None:
+        original_image = load_image(image_path)
     print(f"Processing image: {os.path.basename(image_path)}")
-    
-    # Preprocess the image
-    preprocessed_image = preprocess_image(original_image, scale)
-    
-    # Segment the image
-    segmented_image = segment_coins(preprocessed_image)
-    
-    # Filter the segmented image
-    filtered_image = filter_coins(segmented_image)
-    
-    # Count the coins
-    num_coins, size_differences = count_coins(filtered_image)
-    
+
+    # Run the pipeline, computing the labeled image only when it is displayed
+    outputs = ('count', 'filtered', 'labeled') if visualize else ('count',)
+    results = run_pipeline(original_image, outputs, scale=scale, threshold_method=threshold_method)
+    num_coins, size_differences = results['count']
+
     print(f"Detected {num_coins} coins with {size_differences} size categories")
-    
+
     # Visualize if requested
     if visualize:
-        labeled_image = create_labeled_visualization(filtered_image)
-        visualize_coins(original_image, filtered_image, labeled_image, 
+        visualize_coins(original_image, results['filtered'], results['labeled'], 
                        f"Detected {num_coins} coins with {size_differences} size categories")
-    
+
     return num_coins, size_differences
 
+def process_large_image(image_path, scale=2, memory_budget=256 * 1024 * 1024, raw_shape=None):
+    """
+    Count the coins in a very large image using tiled, out-of-core processing.
+
+    Only a raw file is read tile by tile; any other image is fully decoded
+    first, so its decoded size adds to the memory budget.
+
+    Parameters:
+    image_path: Path to the image file, or to a raw interleaved 8-bit file
+    scale: Scale factor for image resizing
+    memory_budget: Approximate peak memory in bytes for one tile, on top of
+                   the decoded image unless it is a raw file
+    raw_shape: (height, width, channels) of a raw file, which is memory-mapped
+
+    Returns:
+    tuple: (number of coins, number of size differences)
+    """
+    print(f"Processing image: {os.path.basename(image_path)} (tiled)")
+    if raw_shape is not None:
+        source = open_raw_image(image_path, *raw_shape)
+    else:
+        source = load_image(image_path)
+
+    num_coins, size_differences = count_coins_tiled(source, scale, memory_budget=memory_budget)
+    print(f"Detected {num_coins} coins with {size_differences} size categories")
+    return num_coins, size_differences
+
+def process_images(pattern, scale=2, visualize=True, prefetch=4, prefetch_bytes=512 * 1024 * 1024,
+                   threshold_method='otsu'):
+    """
+    Process every image in a directory or matching a glob pattern.
+
+    Upcoming images are decoded on background threads while the current one
+    is being processed.
+
+    Parameters:
+    pattern: Directory path or glob pattern
+    scale: Scale factor for image resizing
+    visualize: Whether to display visualization
+    prefetch: Number of images decoded ahead
+    prefetch_bytes: Memory cap for the prefetched images
+    threshold_method: 'otsu' or 'adaptive' (see segment_coins)
+
+    Returns:
+    dict: Mapping of image path to (number of coins, number of size differences)
+    """
+    image_paths = expand_image_paths(pattern)
+    if not image_paths:
+        print(f"No images found for {pattern}")
+
+    results = {}
+    for image_path, image, error in prefetch_images(image_paths, prefetch, prefetch_bytes):
+        if error is not None:
+            print(f"Error processing {os.path.basename(image_path)}: {error}")
+            continue
+        results[image_path] = process_single_image(image_path, scale, visualize, image, threshold_method)
+    return results
+
+def process_stream(source, scale=2, prefetch=4, change_tolerance=3.0):
+    """
+    Count the coins in every frame of a video or image sequence, in order.
+
+    Only the regions that changed since the previous frames are processed
+    again (see StreamCounter).
+
+    Parameters:
+    source: Video file, directory of frames or glob pattern
+    scale: Scale factor for image resizing
+    prefetch: Number of frames decoded ahead
+    change_tolerance: Mean grey-level difference below which a region counts as unchanged
+
+    Returns:
+    list: One result dict per frame (see count_stream)
+    """
+    results = []
+    for result in count_stream(source, scale, prefetch, change_tolerance=change_tolerance):
+        if 'error' in result:
+            print(f"Error processing {result['frame']}: {result['error']}")
+        else:
+            print(f"{result['frame']}: {result['count']} coins, {result['size_differences']} size categories "
+                  f"({result['mode']}, {result['seconds'] * 1000:.1f} ms)")
+        results.append(result)
+
+    if not results:
+        print(f"No frames found for {source}")
+    return results
+
 def main():
     """Main function to run the coin counter application."""
     parser = argparse.ArgumentParser(description='Coin Counter Application')
     parser.add_argument('--image', type=str, help='Path to a single image to process')
+    parser.add_argument('--images', type=str, help='Directory or glob pattern of images to process')
+    parser.add_argument('--stream', type=str, help='Video file, directory or glob of frames to count frame by frame')
+    parser.add_argument('--change-tolerance', type=float, default=3.0,
+                        help='Mean grey-level change below which a --stream region is reused')
     parser.add_argument('--dataset', action='store_true', help='Download and process the entire dataset')
     parser.add_argument('--evaluate', action='store_true', help='Evaluate accuracy on the dataset')
+    parser.add_argument('--pack', type=str, help='Write the preprocessed dataset to a packed file')
+    parser.add_argument('--pack-scale', type=int, default=8, help='Scale factor of the images written by --pack')
+    parser.add_argument('--packed', type=str,
+                        help='Evaluate from a file written by --pack instead of the images '
+                             '(no download needed unless --report is given)')
+    parser.add_argument('--sweep', action='store_true',
+                        help='Evaluate the dataset for every combination of the sweep parameters below')
+    parser.add_argument('--sweep-scales', nargs='+', type=int, default=[4, 8], help='Scale factors for --sweep')
+    parser.add_argument('--sweep-erosions', nargs='+', type=int, default=[3, 5, 7],
+                        help='Erosion iterations for --sweep')
+    parser.add_argument('--sweep-dilations', nargs='+', type=int, default=[1, 2],
+                        help='Dilation iterations for --sweep')
+    parser.add_argument('--sweep-size-thresholds', nargs='+', type=int, default=[50],
+                        help='Size thresholds for --sweep')
     parser.add_argument('--scale', type=int, default=2, help='Scale factor for image resizing')
     parser.add_argument('--no-viz', action='store_true', help='Disable visualization')
-    
+    parser.add_argument('--threshold', choices=['otsu', 'adaptive'], default='otsu',
+                        help='Thresholding method; adaptive handles unevenly lit photos')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes for --evaluate')
+    parser.add_argument('--stack', type=int, default=1,
+                        help='Number of same-size images processed together in a serial --evaluate')
+    parser.add_argument('--prefetch', type=int, default=4, help='Number of images decoded ahead in batch runs')
+    parser.add_argument('--prefetch-mb', type=int, default=512, help='Memory cap in MB for prefetched images')
+    parser.add_argument('--decode', choices=['full', 'reduced', 'gray'], default='full',
+                        help='Decode --evaluate images at full size, directly at the reduced size, '
+                             'or reduced and straight to grayscale')
+    parser.add_argument('--compare-decode', action='store_true',
+                        help='Compare the accuracy and speed of the decode modes on the dataset')
+    parser.add_argument('--report', type=str,
+                        help='Folder for an HTML report with a diagnostic sheet of every image of --evaluate')
+    parser.add_argument('--cache-dir', type=str, help='Directory for cached results, reused across --evaluate runs')
+    parser.add_argument('--profile', action='store_true', help='Print a per-stage timing and memory breakdown')
+    parser.add_argument('--tiled', action='store_true',
+                        help='Process --image in overlapping tiles to bound processing memory; only --raw-shape '
+                             'input is out-of-core, other formats are fully decoded first. Otsu thresholding only')
+    parser.add_argument('--memory-mb', type=int, default=256, help='Memory budget in MB per tile for --tiled')
+    parser.add_argument('--raw-shape', type=str, help='HxWxC of a raw 8-bit --image file, memory-mapped with --tiled')
+
     args = parser.parse_args()
-    
-    if args.dataset:
+    if args.image and (args.tiled or args.raw_shape) and args.threshold != 'otsu':
+        parser.error("--tiled and --raw-shape only support --threshold otsu")
+
+    if args.profile:
+        instrumentation.enable_memory_tracking()
+
+    if args.evaluate and args.packed and not args.report:
+        # The packed file holds the images and the ground truth, so the dataset is not needed
+        from evaluation import batch_evaluate
+        cache = ResultCache(cache_dir=args.cache_dir, namespace='counts') if args.cache_dir else None
+        batch_evaluate(None, None, workers=args.jobs, cache=cache, packed=args.packed,
+                       threshold_method=args.threshold)
+
+    elif args.dataset:
         # Download the dataset
         dataset_path = download_dataset()
         base_folder = os.path.join(dataset_path, 'coins_images', 'coins_images')
         csv_path = os.path.join(dataset_path, 'coins_count_values.csv')
         
-        if args.evaluate:
+        if args.pack:
+            # Preprocess the dataset once into a single memory-mappable file
+            from packed import pack_dataset
+            pack_dataset(base_folder, csv_path, args.pack, args.pack_scale, args.prefetch)
+        elif args.sweep:
+            # Evaluate every parameter combination and recommend one
+            from sweep import run_sweep
+            run_sweep(base_folder, csv_path, args.sweep_scales, args.sweep_erosions, args.sweep_dilations,
+                      args.sweep_size_thresholds, args.threshold, args.jobs, args.prefetch)
+        elif args.compare_decode:
+            # Check the reduced decodes against the full-resolution path
+            from evaluation import compare_decode_modes
+            compare_decode_modes(base_folder, csv_path)
+        elif args.evaluate:
             # Evaluate the entire dataset
-            batch_evaluate(base_folder, csv_path)
+            from evaluation import batch_evaluate
+            cache = ResultCache(cache_dir=args.cache_dir, namespace='counts') if args.cache_dir else None
+            batch_evaluate(base_folder, csv_path, workers=args.jobs,
+                           prefetch=args.prefetch, prefetch_bytes=args.prefetch_mb * 1024 * 1024,
+                           cache=cache, stack_size=args.stack, packed=args.packed,
+                           report_dir=args.report, threshold_method=args.threshold, decode=args.decode)
         else:
             print(f"Dataset downloaded to {dataset_path}")
-            print(f"To evaluate, use --evaluate flag")
-    
+            print(f"To evaluate, use --evaluate flag (or --sweep to tune the parameters)")
+
+    elif args.image and (args.tiled or args.raw_shape):
+        # Process a very large image tile by tile
+        raw_shape = tuple(int(n) for n in args.raw_shape.lower().split('x')) if args.raw_shape else None
+        process_large_image(args.image, args.scale, args.memory_mb * 1024 * 1024, raw_shape)
+
     elif args.image:
         # Process a single image
-        process_single_image(args.image, args.scale, not args.no_viz)
-    
+        process_single_image(args.image, args.scale, not args.no_viz, threshold_method=args.threshold)
+
+    elif args.stream:
+        # Count frame by frame, reusing the unchanged regions
+        process_stream(args.stream, args.scale, args.prefetch, args.change_tolerance)
+
+    elif args.images:
+        # Process a directory or glob of images
+        process_images(args.images, args.scale, not args.no_viz,
+                       args.prefetch, args.prefetch_mb * 1024 * 1024, args.threshold)
+
     else:
         parser.print_help()
+        return
+
+    if args.profile:
+        print(instrumentation.format_breakdown())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
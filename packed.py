@@ -0,0 +1,129 @@
+"""
+Packed dataset format holding preprocessed images in a single memory-mapped file.
+
+Packing decodes, downscales and blurs every image of a dataset once. Later
+evaluation runs read the preprocessed arrays straight from the file through a
+memory map, without decoding or copying them.
+
+File layout:
+    8 bytes   magic b'COINPK01'
+    8 bytes   offset of the index (little-endian uint64)
+    8 bytes   length of the index in bytes (little-endian uint64)
+    ...       uint8 arrays, each starting at a multiple of 64 bytes
+    ...       UTF-8 JSON index: scale, pipeline parameters and one entry per
+              CSV row with its folder, image_name, coins_count and either the
+              offset, height and width of its array or an error message
+"""
+import json
+import os
+import struct
+
+import numpy as np
+
+from pipeline import run_pipeline, DEFAULT_PARAMS
+from loader import prefetch_images
+
+MAGIC = b'COINPK01'
+_HEADER = struct.Struct('<8sQQ')
+_ALIGNMENT = 64
+
+def pack_dataset(dataset_path, csv_path, output_path, scale=8, prefetch=4):
+    """
+    Preprocess every image listed in a ground truth CSV and write them to a packed file.
+
+    Parameters:
+    dataset_path: Path to the dataset folder
+    csv_path: Path to the CSV file with ground truth data (folder, image_name, coins_count)
+    output_path: Path of the packed file to write
+    scale: Scale factor for image resizing
+    prefetch: Number of images decoded ahead
+
+    Returns:
+    int: Number of images packed
+    """
+    import pandas as pd
+
+    truth_data = pd.read_csv(csv_path)
+    entries = [{'folder': row['folder'], 'image_name': row['image_name'],
+                'coins_count': int(row['coins_count'])}
+               for _, row in truth_data.iterrows()]
+    image_paths = [os.path.join(dataset_path, entry['folder'], entry['image_name']) for entry in entries]
+
+    packed = 0
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, 0, 0))
+        loaded = prefetch_images(image_paths, prefetch)
+        for entry, (image_path, image, error) in zip(entries, loaded):
+            if error is None:
+                try:
+                    preprocessed = run_pipeline(image, ('preprocessed',), arrays=True, scale=scale)['preprocessed']
+                except Exception as e:
+                    error = e
+            if error is not None:
+                print(f"Error packing {entry['image_name']}: {error}")
+                entry['error'] = str(error)
+                continue
+
+            # Align each array so the memory-mapped views are well aligned
+            offset = -(-f.tell() // _ALIGNMENT) * _ALIGNMENT
+            f.write(b'\0' * (offset - f.tell()))
+            f.write(np.ascontiguousarray(preprocessed, dtype=np.uint8).tobytes())
+            entry.update(offset=offset, height=preprocessed.shape[0], width=preprocessed.shape[1])
+            packed += 1
+
+        index = json.dumps({'scale': scale, 'params': {**DEFAULT_PARAMS, 'scale': scale},
+                            'entries': entries}).encode('utf-8')
+        index_offset = f.tell()
+        f.write(index)
+        f.seek(0)
+        f.write(_HEADER.pack(MAGIC, index_offset, len(index)))
+    os.replace(tmp_path, output_path)
+
+    print(f"Packed {packed} of {len(entries)} images to {output_path}")
+    return packed
+
+class PackedDataset:
+    """
+    Read-only view of a file written by pack_dataset.
+
+    The whole file is memory-mapped once; image() returns views into it, so
+    reading an image neither decodes nor copies anything.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size or header[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"Not a packed dataset: {path}")
+            _, index_offset, index_length = _HEADER.unpack(header)
+            f.seek(index_offset)
+            index = json.loads(f.read(index_length).decode('utf-8'))
+
+        self.scale = index['scale']
+        self.params = index['params']
+        self.entries = index['entries']
+        self._data = np.memmap(path, dtype=np.uint8, mode='r')
+
+    def __len__(self):
+        return len(self.entries)
+
+    def image(self, index):
+        """
+        Return the preprocessed image of an entry as a read-only uint8 array.
+
+        Raises:
+        ValueError: If the image could not be read when the dataset was packed
+        """
+        entry = self.entries[index]
+        if 'error' in entry:
+            raise ValueError(entry['error'])
+        size = entry['height'] * entry['width']
+        return self._data[entry['offset']:entry['offset'] + size].reshape(entry['height'], entry['width'])
+
+    def rows(self, dataset_path=''):
+        """Return (image name, true count, image path) for each entry, like load_ground_truth."""
+        return [(entry['image_name'], entry['coins_count'],
+                 os.path.join(dataset_path, entry['folder'], entry['image_name']))
+                for entry in self.entries]
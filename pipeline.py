@@ -0,0 +1,125 @@
+"""
+Stage graph for the coin counter pipeline.
+"""
+from PIL import Image
+
+import numpy as np
+
+from preprocessing import (resize_array, grayscale_array, contrast_array, gaussian_blur_array,
+                           equalize_array, image_histogram)
+from segmentation import segment_array, erode_array, dilate_array
+from counting import label_coins
+from instrumentation import record_stage, input_pixels
+
+# Default pipeline parameters
+DEFAULT_PARAMS = {
+    'scale': 2,
+    'erosion_iterations': 5,
+    'dilation_iterations': 1,
+    'size_threshold': 50,
+    'threshold_method': 'otsu',
+    'block_size': None,
+    'threshold_offset': 4,
+}
+
+# Stage name -> (names of the stages it depends on, function(params, *inputs)).
+# The dependencies may also be a function of the parameters returning the
+# names. 'image' is the original input and is always available. Every stage works on
+# NumPy arrays: uint8 for grayscale images and bool for masks. The mask is
+# labeled once, in 'regions' (a CoinRegions), which 'count' and 'labeled' read.
+STAGES = {
+    'gray': (('image',), lambda p, image: grayscale_array(resize_array(np.asarray(image), p['scale']))),
+    'contrast': (('gray',), lambda p, gray, out=None: contrast_array(gray, 1.5, out)),
+    'preprocessed': (('contrast',), lambda p, contrast: gaussian_blur_array(contrast)),
+    'histogram': (('preprocessed',), lambda p, blurred: image_histogram(blurred)),
+    'equalized': (('preprocessed', 'histogram'),
+                  lambda p, blurred, histogram: equalize_array(blurred, 256, histogram)),
+    # Only Otsu thresholding reads the histogram
+    'segmented': (lambda p: ('preprocessed', 'histogram') if p['threshold_method'] == 'otsu' else ('preprocessed',),
+                  lambda p, blurred, histogram=None: segment_array(blurred, p['threshold_method'], histogram,
+                                                                   p['block_size'], p['threshold_offset'])),
+    'eroded': (('segmented',), lambda p, segmented, out=None: erode_array(segmented, p['erosion_iterations'], out)),
+    'dilated': (('eroded',), lambda p, eroded, out=None: dilate_array(eroded, p['dilation_iterations'], out)),
+    'filtered': (('dilated',), lambda p, dilated: dilated),
+    'regions': (('filtered',), lambda p, filtered: label_coins(filtered)),
+    'count': (('regions',), lambda p, regions: regions.count(p['size_threshold'])),
+    'labeled': (('regions',), lambda p, regions: regions.labels),
+}
+
+# Stages whose function can write its result over its single input (out=)
+IN_PLACE_STAGES = {'contrast', 'eroded', 'dilated'}
+
+# Stages returned as PIL Images unless run_pipeline is asked for arrays
+IMAGE_STAGES = {'gray', 'contrast', 'preprocessed', 'equalized', 'segmented', 'filtered'}
+
+def _dependencies(name, params):
+    """Return the names of the stages a stage depends on with the given parameters."""
+    dependencies = STAGES[name][0]
+    return dependencies(params) if callable(dependencies) else dependencies
+
+def _needed_stages(outputs, results, params):
+    """Return the stages that must run to produce outputs, and how many of them use each result."""
+    needed, users = [], {}
+
+    def visit(name):
+        if name in results or name in needed:
+            return
+        if name not in STAGES:
+            raise ValueError(f"Unknown pipeline stage: {name}")
+        for dependency in _dependencies(name, params):
+            users[dependency] = users.get(dependency, 0) + 1
+            visit(dependency)
+        needed.append(name)
+
+    for name in outputs:
+        visit(name)
+    return needed, users
+
+def run_pipeline(image, outputs=('count',), results=None, arrays=False, **params):
+    """
+    Compute the requested pipeline outputs, running only the stages they depend on.
+
+    An intermediate result that is neither requested nor used by another
+    stage of this run is overwritten in place by the next stage (see
+    IN_PLACE_STAGES) and removed from results. Results passed in by the
+    caller are never overwritten.
+
+    Parameters:
+    image: The original input image (PIL Image or NumPy array)
+    outputs: Names of the stages whose results are wanted (see STAGES)
+    results: Optional dict of stage results computed earlier for the same image
+             and parameters; it is filled in place with this run's results,
+             except the intermediates overwritten in place, so a later run
+             with the same dict recomputes those if it needs them (request
+             them as outputs to keep them)
+    arrays: Whether to return image outputs as NumPy arrays instead of PIL Images
+    params: Overrides for DEFAULT_PARAMS
+
+    Returns:
+    dict: Mapping of each requested output name to its result
+    """
+    unknown = set(params) - set(DEFAULT_PARAMS)
+    if unknown:
+        raise TypeError(f"Unknown pipeline parameters: {', '.join(sorted(unknown))}")
+    params = {**DEFAULT_PARAMS, **params}
+
+    if results is None:
+        results = {}
+    results.setdefault('image', image)
+
+    needed, users = _needed_stages(outputs, results, params)
+    for name in needed:
+        dependencies, function = _dependencies(name, params), STAGES[name][1]
+        inputs = [results[dependency] for dependency in dependencies]
+        source = dependencies[0]
+        with record_stage(name, input_pixels(inputs[0])):
+            if (name in IN_PLACE_STAGES and source in needed and source not in outputs
+                    and users[source] == 1):
+                # Nothing else reads the input, so reuse its buffer
+                results[name] = function(params, *inputs, out=inputs[0])
+                del results[source]
+            else:
+                results[name] = function(params, *inputs)
+
+    return {name: Image.fromarray(results[name]) if name in IMAGE_STAGES and not arrays else results[name]
+            for name in outputs}
@@ -4,70 +4,154 @@ Image preprocessing module for the coin counter application.
 import numpy as np
 from PIL import Image
 
-def convert_to_grayscale(img, scale=2):
-    """Convert an image to grayscale and resize it according to a given factor."""
-    img = np.array(img)  # Convert the image to a NumPy array
-    height, width, channels = img.shape
-
-    # Resize the image
-    height, width = height // scale, width // scale
-    img = np.array(Image.fromarray(img).resize((width, height), Image.Resampling.LANCZOS))
-
-    # Initialize an empty array for the grayscale image
+def grayscale_array(rgb_array):
+    """
+    Average the channels of an RGB(A) array into a uint8 grayscale array.
+
+    The channels are on the last axis, so a stack of images of shape
+    (N, H, W, C) is converted in one call.
+
+    The channel sum is accumulated in uint8, exactly like the original
+    per-pixel ``int(sum(img[i][j]) / 3)``, so results wrap around for bright
+    pixels in the same way.
+    """
+    rgb_array = np.asarray(rgb_array)
+    return rgb_array.sum(axis=-1, dtype=np.uint8) // 3
+
+def gaussian_blur_array(gray_array):
+    """
+    Apply the 3x3 [1, 2, 1] Gaussian kernel to a uint8 grayscale array.
+
+    Border rows and columns are left at zero. Each weighted term wraps in
+    uint8 before being summed, matching the original per-pixel loop. The
+    kernel runs over the last two axes, so a stack of images of shape
+    (N, H, W) is blurred in one call.
+    """
+    img = np.asarray(gray_array, dtype=np.uint8)
+
+    # Weighted copies of the image; the multiplications wrap in uint8
+    x1 = img.astype(np.uint16)
+    x2 = (img * np.uint8(2)).astype(np.uint16)
+    x4 = (img * np.uint8(4)).astype(np.uint16)
+
+    total = x1[..., :-2, :-2] + x2[..., :-2, 1:-1] + x1[..., :-2, 2:]
+    total += x2[..., 1:-1, :-2] + x4[..., 1:-1, 1:-1] + x2[..., 1:-1, 2:]
+    total += x1[..., 2:, :-2] + x2[..., 2:, 1:-1] + x1[..., 2:, 2:]
+
+    # Normalize and clamp to the valid range
+    blurred = np.zeros(img.shape, dtype=np.uint8)
+    blurred[..., 1:-1, 1:-1] = np.clip(total // 16, 0, 255)
+    return blurred
+
+def resize_array(rgb_array, scale=2):
+    """Downscale an image array by an integer factor with a LANCZOS filter."""
+    rgb_array = np.asarray(rgb_array)
+    height, width = rgb_array.shape[0] // scale, rgb_array.shape[1] // scale
+    return np.asarray(Image.fromarray(rgb_array).resize((width, height), Image.Resampling.LANCZOS))
+
+def contrast_array(gray_array, factor=1.5, out=None):
+    """
+    Apply the contrast adjustment of adjust_contrast to a uint8 array.
+
+    Pass out=gray_array to adjust the array in place.
+    """
+    return np.take(contrast_lut(factor), gray_array, out=out)
+
+def preprocess_array(rgb_array, scale=2):
+    """
+    Run the preprocessing of preprocess_image on an image array.
+
+    Returns:
+    numpy.ndarray: The blurred uint8 grayscale array
+    """
+    gray_array = grayscale_array(resize_array(rgb_array, scale))
+    return gaussian_blur_array(contrast_array(gray_array, 1.5, out=gray_array))
+
+def _grayscale_reference(img):
+    """Per-pixel grayscale conversion used to check parity of grayscale_array."""
+    height, width = img.shape[:2]
     gray_array = np.zeros([height, width], dtype=np.uint8)
-
-    # Convert each pixel to grayscale by averaging the RGB values
     for i in range(height):
         for j in range(width):
             gray_array[i][j] = int(sum(img[i][j]) / 3)
+    return gray_array
+
+def _gaussian_blur_reference(img):
+    """Per-pixel Gaussian blur used to check parity of gaussian_blur_array."""
+    height, width = img.shape
+    blurred = np.zeros([height, width], dtype=np.uint8)
+    for i in range(1, height - 1):
+        for j in range(1, width - 1):
+            pixel = int(img[i - 1][j - 1] * 1)
+            pixel += int(img[i - 1][j] * 2)
+            pixel += int(img[i - 1][j + 1] * 1)
+            pixel += int(img[i][j - 1] * 2)
+            pixel += int(img[i][j] * 4)
+            pixel += int(img[i][j + 1] * 2)
+            pixel += int(img[i + 1][j - 1] * 1)
+            pixel += int(img[i + 1][j] * 2)
+            pixel += int(img[i + 1][j + 1] * 1)
+            blurred[i][j] = check_overflow(int(pixel / 16))
+    return blurred
+
+def _check_parity(stage, result, reference):
+    """
+    Raise ValueError if a vectorized result differs from its reference.
+
+    The functions taking parity=True (here and in segmentation.py) also run
+    their slow per-pixel reference implementation and compare it with this.
+    """
+    if not np.array_equal(result, reference):
+        raise ValueError(f"{stage}: vectorized output differs from the per-pixel reference")
+
+def convert_to_grayscale(img, scale=2, parity=False):
+    """
+    Convert an image to grayscale and resize it according to a given factor.
+    With parity=True the result is checked as described in _check_parity.
+    """
+    # Resize the image
+    img = resize_array(np.asarray(img), scale)
+
+    # Convert each pixel to grayscale by averaging the RGB values
+    gray_array = grayscale_array(img)
+    if parity:
+        _check_parity("convert_to_grayscale", gray_array, _grayscale_reference(img))
 
     # Create a grayscale image from the array
     gray_image = Image.fromarray(gray_array)
     return gray_image
 
-def adjust_contrast(image, factor=1.5):
-    """Adjust the contrast of an image using the given factor."""
+def contrast_lut(factor=1.5):
+    """Return the contrast adjustment of adjust_contrast as a lookup table for uint8 values."""
     # Define the contrast adjustment formula
     def adjust_pixel(value):
         return max(0, min(255, int(128 + factor * (value - 128))))
     
+    return np.array([adjust_pixel(value) for value in range(256)], dtype=np.uint8)
+
+def adjust_contrast(image, factor=1.5):
+    """Adjust the contrast of an image using the given factor."""
     # Apply the adjustment to each pixel
-    return image.point(adjust_pixel)
+    return image.point(contrast_lut(factor).tolist())
 
-def apply_gaussian_blur(img):
-    """Apply a Gaussian blur filter to a grayscale image."""
+def apply_gaussian_blur(img, parity=False):
+    """
+    Apply a Gaussian blur filter to a grayscale image.
+    With parity=True the result is checked as described in _check_parity.
+    """
     img = np.array(img)  # Convert the image to a NumPy array
 
     # Check if the image is grayscale; convert if not
     if len(img.shape) > 2:
-        height, width, _ = img.shape
-        # Convert to grayscale
-        gray_array = np.zeros([height, width], dtype=np.uint8)
-        for i in range(height):
-            for j in range(width):
-                gray_array[i][j] = int(sum(img[i][j]) / 3)
-        img = gray_array
-    
-    height, width = img.shape
-
-    # Initialize an empty array for the blurred image
-    blurred = np.zeros([height, width], dtype=np.uint8)
-
-    # Apply the Gaussian kernel manually
-    for i in range(1, height - 1):
-        for j in range(1, width - 1):
-            pixel = int(img[i - 1][j - 1] * 1)
-            pixel += int(img[i - 1][j] * 2)
-            pixel += int(img[i - 1][j + 1] * 1)
-            pixel += int(img[i][j - 1] * 2)
-            pixel += int(img[i][j] * 4)
-            pixel += int(img[i][j + 1] * 2)
-            pixel += int(img[i + 1][j - 1] * 1)
-            pixel += int(img[i + 1][j] * 2)
-            pixel += int(img[i + 1][j + 1] * 1)
+        rgb = img
+        img = grayscale_array(rgb)
+        if parity:
+            _check_parity("apply_gaussian_blur", img, _grayscale_reference(rgb))
 
-            # Normalize the pixel value and ensure it's in the valid range
-            blurred[i][j] = check_overflow(int(pixel / 16))
+    # Apply the Gaussian kernel
+    blurred = gaussian_blur_array(img)
+    if parity:
+        _check_parity("apply_gaussian_blur", blurred, _gaussian_blur_reference(img))
 
     # Create a blurred image from the array
     blurred_image = Image.fromarray(blurred)
@@ -81,16 +165,29 @@ def check_overflow(pixel):
         pixel = 255
     return pixel
 
-def equalize_histogram(img, bins=256):
-    """Apply histogram equalization to enhance image contrast."""
-    img = np.array(img)
-    img_flat = img.flatten()
+def image_histogram(img, bins=256):
+    """
+    Count the occurrences of each pixel value of an 8-bit image.
+
+    The histogram is computed once per image and shared by every stage that
+    needs it (Otsu thresholding, equalization, plots).
+    """
+    img_flat = np.asarray(img).ravel()
+    return np.bincount(img_flat, minlength=bins)
 
-    histogram = np.zeros(bins)
+def equalize_array(img, bins=256, histogram=None):
+    """
+    Apply histogram equalization to a uint8 array, as equalize_histogram does.
+
+    Returns:
+    numpy.ndarray: The equalized uint8 array
+    """
+    img = np.asarray(img)
 
     # Histogram: count occurrences of each pixel value
-    for pixel in img_flat:
-        histogram[pixel] += 1
+    if histogram is None:
+        histogram = image_histogram(img, bins)
+    histogram = np.asarray(histogram, dtype=float)
 
     # Cumulative sum of the histogram
     cs = np.cumsum(histogram)
@@ -102,34 +199,36 @@ def equalize_histogram(img, bins=256):
     cs = cs.astype('uint8')
 
     # Apply the transformation to the image pixels
-    img_new = cs[img_flat]
-
-    # Reshape the transformed image
-    img_new = np.reshape(img_new, img.shape)
+    img_new = cs[img]
 
     # Add borders to the image for visualization
     img_new[0, :] = 200
     img_new[:, 0] = 200
     img_new[:, -1] = 200
     img_new[-1, :] = 200
+    return img_new
 
+def equalize_histogram(img, bins=256, histogram=None):
+    """
+    Apply histogram equalization to enhance image contrast.
+
+    A histogram already computed with image_histogram can be passed to avoid
+    recomputing it.
+    """
     # Convert to PIL Image
-    img_new = Image.fromarray(img_new)
-    return img_new
+    return Image.fromarray(equalize_array(np.asarray(img), bins, histogram))
 
-def preprocess_image(image, scale=2):
+def preprocess_image(image, scale=2, parity=False):
     """Apply the complete preprocessing pipeline to an image."""
     # Convert to grayscale and resize
-    gray_image = convert_to_grayscale(image, scale)
+    gray_image = convert_to_grayscale(image, scale, parity)
     
     # Adjust contrast
     adjusted_image = adjust_contrast(gray_image, 1.5)
     
     # Apply Gaussian blur
-    blurred_image = apply_gaussian_blur(adjusted_image)
-    
-    # Apply histogram equalization
-    equalized_image = equalize_histogram(blurred_image, 256)
+    blurred_image = apply_gaussian_blur(adjusted_image, parity)
     
-    # Return the preprocessed image
-    return blurred_image  # Using blurred image as the final result
\ No newline at end of file
+    # Return the preprocessed image (histogram equalization is only computed
+    # on demand, see the 'equalized' stage in pipeline.py)
+    return blurred_image
\ No newline at end of file
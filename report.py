@@ -0,0 +1,228 @@
+"""
+Headless diagnostic reports for the coin counter application.
+
+Each image's diagnostic sheet (the same panels as the evaluate_image figure)
+is composed directly from the pipeline's intermediate arrays with PIL, so no
+display and no matplotlib are needed. Sheets are rendered in parallel and
+linked from a browsable HTML index.
+"""
+import html
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from pipeline import run_pipeline
+from preprocessing import image_histogram
+from loader import load_image, prefetch_images
+import instrumentation
+
+PANEL_SIZE = 240
+PANEL_MARGIN = 8
+CAPTION_HEIGHT = 18
+TITLE_HEIGHT = 28
+BACKGROUND = (255, 255, 255)
+TEXT_COLOR = (0, 0, 0)
+
+# Pipeline outputs a diagnostic sheet is built from
+REPORT_STAGES = ('preprocessed', 'histogram', 'segmented', 'eroded', 'dilated', 'filtered', 'count')
+
+def _image_panel(image, width, height):
+    """Fit an image or array into a width x height RGB panel, keeping its aspect ratio."""
+    if not isinstance(image, Image.Image):
+        image = Image.fromarray(np.asarray(image))
+    image = image.convert('RGB')
+    factor = min(width / image.width, height / image.height)
+    size = (max(1, round(image.width * factor)), max(1, round(image.height * factor)))
+    # Small masks are enlarged without smoothing so single pixels stay visible
+    image = (image.resize(size, Image.BILINEAR, reducing_gap=2.0) if factor < 1
+             else image.resize(size, Image.NEAREST))
+    panel = Image.new('RGB', (width, height), BACKGROUND)
+    panel.paste(image, ((width - image.width) // 2, (height - image.height) // 2))
+    return panel
+
+def _histogram_panel(histogram, width, height):
+    """Draw a 256-bin histogram as a filled bar chart in a width x height RGB panel."""
+    histogram = np.asarray(histogram, dtype=np.float64)
+    # Each column shows the tallest of the bins it covers
+    starts = np.arange(width) * len(histogram) // width
+    columns = np.maximum.reduceat(histogram, starts)
+    peak = columns.max()
+    bar_heights = np.round(columns / peak * (height - 1)).astype(np.intp) if peak > 0 else np.zeros(width, np.intp)
+    filled = np.arange(height)[:, None] >= height - bar_heights[None, :]
+    pixels = np.where(filled[..., None], np.uint8(150), np.uint8(255)).repeat(3, axis=2)
+    pixels[-1] = 0  # Baseline
+    return Image.fromarray(pixels)
+
+def render_diagnostic(original_image, stages, title):
+    """
+    Compose the diagnostic sheet of one image.
+
+    Parameters:
+    original_image: The original input image
+    stages: run_pipeline results with at least the REPORT_STAGES outputs
+    title: Text shown above the panels
+
+    Returns:
+    PIL.Image: RGB sheet with the preprocessing steps, both histograms and
+               the segmentation steps
+    """
+    cell = PANEL_SIZE + CAPTION_HEIGHT
+    inner = PANEL_SIZE - PANEL_MARGIN
+    wide = 2 * PANEL_SIZE - 2 * PANEL_MARGIN
+    sheet = Image.new('RGB', (4 * PANEL_SIZE, TITLE_HEIGHT + 3 * cell), BACKGROUND)
+    draw = ImageDraw.Draw(sheet)
+    draw.text((8, 8), title, fill=TEXT_COLOR)
+
+    # (row, column, columns spanned, caption, panel)
+    panels = [
+        (0, 0, 1, 'Original Image', _image_panel(original_image, inner, inner)),
+        (0, 1, 1, 'Grayscale Image', _image_panel(stages['preprocessed'], inner, inner)),
+        (0, 2, 1, 'Segmented Image', _image_panel(stages['segmented'], inner, inner)),
+        (0, 3, 1, 'Filtered Image', _image_panel(stages['filtered'], inner, inner)),
+        (1, 0, 2, 'Histogram of Original Image',
+         _histogram_panel(image_histogram(np.asarray(original_image)), wide, inner)),
+        (1, 2, 2, 'Histogram of Preprocessed Image',
+         _histogram_panel(stages['histogram'], wide, inner)),
+        (2, 0, 1, 'Segmented Image', _image_panel(stages['segmented'], inner, inner)),
+        (2, 1, 1, 'Eroded Image', _image_panel(stages['eroded'], inner, inner)),
+        (2, 2, 1, 'Dilated Image', _image_panel(stages['dilated'], inner, inner)),
+    ]
+    for row, column, span, caption, panel in panels:
+        left = column * PANEL_SIZE + (span * PANEL_SIZE - panel.width) // 2
+        top = TITLE_HEIGHT + row * cell
+        draw.text((left + 4, top + 3), caption, fill=TEXT_COLOR)
+        sheet.paste(panel, (left, top + CAPTION_HEIGHT + PANEL_MARGIN // 2))
+    return sheet
+
+def diagnostic_title(image_name, predicted_count, true_count=None):
+    """Return the sheet title, as in the evaluate_image figure."""
+    title = f"Image: {image_name}, Predicted Count: {predicted_count}"
+    if true_count is not None:
+        title += f", Actual Count: {true_count}"
+        title += f", {'Correct' if predicted_count == true_count else 'Incorrect'}"
+    return title
+
+def _render_image(image_path, true_count, sheet_path, scale, threshold_method='otsu', original_image=None):
+    """
+    Count the coins in an image and save its diagnostic sheet.
+
+    Runs in a worker process when render_report is parallel, so errors are
+    returned as messages instead of being raised.
+
+    Returns:
+    tuple: ((predicted count, size differences), None) or (None, error message)
+    """
+    try:
+        if original_image is None:
+            original_image = load_image(image_path)
+        print(f"Rendering report for image: {os.path.basename(image_path)}")
+        stages = run_pipeline(original_image, REPORT_STAGES, arrays=True, scale=scale,
+                              threshold_method=threshold_method)
+        predicted_count, _ = stages['count']
+        sheet = render_diagnostic(original_image, stages,
+                                  diagnostic_title(os.path.basename(image_path), predicted_count, true_count))
+        # Fast compression: the sheets are mostly flat masks
+        sheet.save(sheet_path, format='PNG', compress_level=1)
+        return stages['count'], None
+    except Exception as e:
+        return None, str(e)
+
+def _render_image_in_worker(image_path, true_count, sheet_path, scale, threshold_method):
+    """Run _render_image in a worker process and return its stage statistics with the outcome."""
+    instrumentation.reset()
+    outcome = _render_image(image_path, true_count, sheet_path, scale, threshold_method)
+    return outcome, instrumentation.snapshot()
+
+def sheet_filename(index, image_name):
+    """Return the file name of a diagnostic sheet, unique even if image names repeat across folders."""
+    return f"{index:05d}_{os.path.splitext(image_name)[0]}.png"
+
+def render_report(rows, report_dir, scale=8, threshold_method='otsu', workers=1, prefetch=4,
+                  prefetch_bytes=512 * 1024 * 1024):
+    """
+    Count the coins in each image and save its diagnostic sheet to report_dir.
+
+    Parameters:
+    rows: (image name, true count, image path) tuples, as from load_ground_truth
+    report_dir: Folder for the sheets (created if missing)
+    scale: Scale factor for image resizing
+    threshold_method: 'otsu' or 'adaptive' (see segment_coins)
+    workers: Number of worker processes rendering in parallel
+    prefetch: Number of images decoded ahead in a serial run
+    prefetch_bytes: Memory cap for the prefetched images
+
+    Yields:
+    tuple: The outcome of _render_image for each row, in order
+    """
+    os.makedirs(report_dir, exist_ok=True)
+    image_paths = [image_path for _, _, image_path in rows]
+    sheet_paths = [os.path.join(report_dir, sheet_filename(index, image_name))
+                   for index, (image_name, _, _) in enumerate(rows)]
+    true_counts = [true_count for _, true_count, _ in rows]
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for outcome, stage_stats in executor.map(_render_image_in_worker, image_paths, true_counts,
+                                                     sheet_paths, repeat(scale), repeat(threshold_method)):
+                instrumentation.merge(stage_stats)
+                yield outcome
+    else:
+        loaded = prefetch_images(image_paths, prefetch, prefetch_bytes)
+        for (image_path, image, error), true_count, sheet_path in zip(loaded, true_counts, sheet_paths):
+            if error is not None:
+                yield None, str(error)
+                continue
+            yield _render_image(image_path, true_count, sheet_path, scale, threshold_method, image)
+
+def write_html_report(results, report_dir, accuracy=None, errors=()):
+    """
+    Write report_dir/index.html listing every evaluated image with its sheet.
+
+    Parameters:
+    results: Result dicts as collected by batch_evaluate, each with a 'report' sheet file name
+    report_dir: Folder holding the sheets
+    accuracy: Overall accuracy in percent, if known
+    errors: (image name, error message) for the images that could not be processed
+
+    Returns:
+    str: Path of the index file
+    """
+    correct = sum(1 for result in results if result.get('correct'))
+    summary = f"{len(results)} images, {len(results) - correct} incorrect"
+    if accuracy is not None:
+        summary += f", accuracy {accuracy:.2f}%"
+
+    lines = [
+        "<!DOCTYPE html>",
+        "<html><head><meta charset=\"utf-8\"><title>Coin Counter Report</title>",
+        "<style>body{font-family:sans-serif;margin:2em}table{border-collapse:collapse}"
+        "td,th{border:1px solid #ccc;padding:4px 8px;text-align:left}"
+        "tr.incorrect{background:#fdd}img{width:240px}</style></head><body>",
+        "<h1>Coin Counter Report</h1>",
+        f"<p>{html.escape(summary)}</p>",
+        "<table><tr><th>Image</th><th>True count</th><th>Predicted count</th>"
+        "<th>Size differences</th><th>Diagnostics</th></tr>",
+    ]
+    for result in results:
+        sheet = html.escape(result.get('report', ''), quote=True)
+        lines.append(
+            f"<tr class=\"{'correct' if result.get('correct') else 'incorrect'}\">"
+            f"<td>{html.escape(str(result['image_name']))}</td>"
+            f"<td>{html.escape(str(result.get('true_count', '')))}</td>"
+            f"<td>{result['predicted_count']}</td><td>{result['size_differences']}</td>"
+            f"<td><a href=\"{sheet}\"><img src=\"{sheet}\" loading=\"lazy\" alt=\"\"></a></td></tr>")
+    lines.append("</table>")
+    if errors:
+        lines.append("<h2>Errors</h2><ul>")
+        lines.extend(f"<li>{html.escape(str(image_name))}: {html.escape(str(error))}</li>"
+                     for image_name, error in errors)
+        lines.append("</ul>")
+    lines.append("</body></html>")
+
+    index_path = os.path.join(report_dir, 'index.html')
+    with open(index_path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+    return index_path
@@ -2,142 +2,373 @@
 Image segmentation module for the coin counter application.
 """
 import numpy as np
+from scipy import ndimage as ndi
 from PIL import Image
 
-def otsu_threshold(image):
+from preprocessing import _check_parity
+
+def otsu_threshold(image, histogram=None, parity=False):
     """
     Apply Otsu's method to determine the optimal threshold for segmentation.
+
+    A 256-bin histogram of the image that was already computed, e.g. by
+    preprocessing.image_histogram, can be passed to avoid recomputing it.
+    With parity=True the threshold is checked against the per-bin reference
+    (see preprocessing._check_parity).
     """
-    # Convert the image to a NumPy array
-    image_array = np.array(image)
+    if histogram is None:
+        # Convert the image to a NumPy array
+        image_array = np.array(image)
+
+        # Calculate the histogram and class edges
+        histogram, bin_edges = np.histogram(image_array, bins=256, range=(0, 256))
 
-    # Calculate the histogram and class edges
-    histogram, bin_edges = np.histogram(image_array, bins=256, range=(0, 256))
+    threshold = otsu_threshold_from_histogram(histogram)
+    if parity:
+        _check_parity("otsu_threshold", threshold, _otsu_threshold_reference(histogram))
+    return threshold
+
+def otsu_threshold_from_histogram(histogram):
+    """
+    Apply Otsu's method to a 256-bin intensity histogram.
+
+    The between-class variance is evaluated for all 256 candidate thresholds
+    at once with cumulative sums; the first threshold with the largest
+    positive variance is returned, as in the original per-bin loop.
+    """
+    return int(otsu_thresholds_from_histograms(np.asarray(histogram)[None, :])[0])
+
+def otsu_thresholds_from_histograms(histograms):
+    """
+    Apply Otsu's method to each row of an (N, 256) array of histograms.
+
+    Returns:
+    numpy.ndarray: The N thresholds
+    """
+    histograms = np.asarray(histograms, dtype=np.int64)
 
     # Total number of pixels
-    total_pixels = image_array.size
+    total_pixels = histograms.sum(axis=1, keepdims=True)
 
-    # Variables for Otsu's method
+    # Background weight and intensity sum for every candidate threshold
+    weight_background = np.cumsum(histograms, axis=1)
+    weight_foreground = total_pixels - weight_background
+    sum_background = np.cumsum(np.arange(256) * histograms, axis=1)
+    sum_total = sum_background[:, -1:]  # Sum of all pixel intensities
+
+    # Thresholds that leave both classes non-empty
+    valid = (weight_background > 0) & (weight_foreground > 0)
+
+    # Calculate means and between-class variance
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_background = sum_background / weight_background
+        mean_foreground = (sum_total - sum_background) / weight_foreground
+        between_class_variance = (
+            weight_background * weight_foreground * (mean_background - mean_foreground) ** 2
+        )
+    between_class_variance = np.where(valid, between_class_variance, 0)
+
+    # Pick the first threshold with the largest variance, or 0 if none is positive
+    thresholds = np.argmax(between_class_variance, axis=1)
+    best = np.take_along_axis(between_class_variance, thresholds[:, None], axis=1)[:, 0]
+    return np.where(best > 0, thresholds, 0)
+
+def _otsu_threshold_reference(histogram):
+    """Per-bin Otsu search used to check parity of otsu_threshold_from_histogram."""
+    total_pixels = int(np.sum(histogram))
     current_max, threshold = 0, 0
-    sum_total = np.dot(np.arange(256), histogram)  # Sum of all pixel intensities
+    sum_total = np.dot(np.arange(256), histogram)
     sum_background, weight_background, weight_foreground = 0, 0, 0
 
     for i in range(256):
-        # Update background weight
         weight_background += histogram[i]
         if weight_background == 0:
             continue
-
-        # Update foreground weight
         weight_foreground = total_pixels - weight_background
         if weight_foreground == 0:
             break
-
-        # Update background sum
         sum_background += i * histogram[i]
-
-        # Calculate means and between-class variance
         mean_background = sum_background / weight_background
         mean_foreground = (sum_total - sum_background) / weight_foreground
         between_class_variance = (
             weight_background * weight_foreground * (mean_background - mean_foreground) ** 2
         )
-
-        # Check if this variance is the largest
         if between_class_variance > current_max:
             current_max = between_class_variance
             threshold = i
     return threshold
 
-def segment_coins(image):
+def adaptive_threshold(image, block_size=None, offset=4):
+    """
+    Segment an image by comparing each pixel to the mean of its neighbourhood.
+
+    The local means come from an integral image (summed-area table), so the
+    cost does not depend on the block size. Windows are clipped at the image
+    borders.
+
+    Parameters:
+    image: Grayscale image (PIL Image or NumPy array)
+    block_size: Side of the square neighbourhood; it should be a few times
+                larger than a coin (defaults to a quarter of the shorter side)
+    offset: How much brighter than the local mean a pixel must be to be
+            foreground; a small positive offset keeps background noise out
+
+    Returns:
+    numpy.ndarray: Boolean foreground mask
+    """
+    image_array = np.asarray(image, dtype=np.int64)
+    height, width = image_array.shape
+    if block_size is None:
+        block_size = max(3, min(height, width) // 4)
+    radius = block_size // 2
+
+    # Summed-area table with a leading row and column of zeros
+    integral = np.zeros((height + 1, width + 1), dtype=np.int64)
+    integral[1:, 1:] = image_array.cumsum(axis=0).cumsum(axis=1)
+
+    # Window bounds of every row and column, clipped to the image
+    top = np.clip(np.arange(height) - radius, 0, height)
+    bottom = np.clip(np.arange(height) + radius + 1, 0, height)
+    left = np.clip(np.arange(width) - radius, 0, width)
+    right = np.clip(np.arange(width) + radius + 1, 0, width)
+
+    window_sum = (integral[np.ix_(bottom, right)] - integral[np.ix_(top, right)]
+                  - integral[np.ix_(bottom, left)] + integral[np.ix_(top, left)])
+    window_area = (bottom - top)[:, None] * (right - left)[None, :]
+
+    # pixel > mean + offset, compared in integers
+    return image_array * window_area > window_sum + offset * window_area
+
+def segment_array(image_array, method='otsu', histogram=None, block_size=None, offset=4):
     """
-    Segment an image using Otsu's thresholding method.
+    Segment a uint8 grayscale array, as segment_coins does.
+
+    Returns:
+    numpy.ndarray: Boolean foreground mask
     """
+    if method == 'adaptive':
+        return adaptive_threshold(image_array, block_size, offset)
+    if method != 'otsu':
+        raise ValueError(f"Unknown thresholding method: {method}")
+
     # Calculate Otsu's threshold
-    threshold = otsu_threshold(image)
+    if histogram is None:
+        histogram = np.bincount(np.asarray(image_array).ravel(), minlength=256)
+    threshold = otsu_threshold_from_histogram(histogram)
 
     # Apply thresholding
-    binary_image = image.point(lambda p: 255 if p > threshold else 0, mode='1')
+    return np.asarray(image_array) > threshold
+
+def segment_coins(image, method='otsu', histogram=None, block_size=None, offset=4):
+    """
+    Segment an image using Otsu's thresholding method or adaptive thresholding.
 
-    return binary_image
+    Parameters:
+    image: Grayscale image (PIL Image)
+    method: 'otsu' for a global threshold, or 'adaptive' for a threshold that
+            follows the local brightness, for unevenly lit photos
+    histogram: Precomputed 256-bin histogram of the image, for 'otsu'
+    block_size, offset: Neighbourhood size and offset for 'adaptive'
 
-def erode(img, iterations=1):
+    Returns:
+    PIL.Image: Binary image of mode '1'
     """
-    Apply erosion to a binary image.
+    return Image.fromarray(segment_array(np.asarray(image), method, histogram, block_size, offset))
+
+# 4-neighbour structuring element acting within each image of an (N, H, W) stack
+_STACK_CROSS = np.zeros((3, 3, 3), dtype=bool)
+_STACK_CROSS[1] = ndi.generate_binary_structure(2, 1)
+
+def _distance_to_false(mask, copy=True):
     """
-    # Convert the image to a NumPy array
-    img = np.array(img)
-    height, width = img.shape  # Get image dimensions
+    Taxicab distance from each pixel to the nearest False pixel of its image.
+
+    mask is a single image or an (N, H, W) stack; distances never cross from
+    one image of a stack to another. The four corner pixels are treated as
+    True because they are not 4-neighbours of any interior pixel, which
+    modifies mask itself if copy is False. Images without any False pixel
+    get the largest representable distance.
+    """
+    source = mask.copy() if copy else mask
+    source[..., [0, 0, -1, -1], [0, -1, 0, -1]] = True
+    metric = 'taxicab' if mask.ndim == 2 else _STACK_CROSS
+    distance = ndi.distance_transform_cdt(source, metric=metric)
+    distance[distance < 0] = np.iinfo(distance.dtype).max
+    return distance
+
+def erode_array_levels(mask, levels):
+    """
+    Erode a binary array by several iteration counts with a single distance transform.
 
-    for it in range(iterations):  # Repeat erosion for the specified number of iterations
-        delete_i = []  # List to store row indices of pixels to delete
-        delete_j = []  # List to store column indices of pixels to delete
+    Parameters:
+    mask: Binary array, as for erode_array
+    levels: Iteration counts
 
-        # Iterate through each pixel inside the image borders
+    Returns:
+    dict: Iteration count -> eroded mask, equal to erode_array(mask, count)
+    """
+    mask = np.asarray(mask, dtype=bool)
+    height, width = mask.shape[-2:]
+    if height < 3 or width < 3 or all(iterations < 1 for iterations in levels):
+        return {iterations: mask.copy() for iterations in levels}
+
+    distance = _distance_to_false(mask)
+    eroded = {}
+    for iterations in levels:
+        result = mask.copy()
+        if iterations >= 1:
+            result[..., 1:-1, 1:-1] = distance[..., 1:-1, 1:-1] > iterations
+        eroded[iterations] = result
+    return eroded
+
+def _prepare_output(mask, out):
+    """Return the array a morphology result is written to, holding a copy of mask."""
+    if out is None:
+        return mask.copy()
+    if out is not mask:
+        out[...] = mask
+    return out
+
+def erode_array(mask, iterations=1, out=None):
+    """
+    Apply `iterations` passes of 4-neighbour erosion to a binary array.
+
+    Border pixels are never modified. N passes are equivalent to removing
+    every interior pixel within a taxicab distance of N of a False pixel,
+    so the work is done with a single distance transform. A stack of
+    images of shape (N, H, W) is processed image by image in one call.
+    Pass a boolean out=mask to erode the mask in place.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    result = _prepare_output(mask, out)
+    height, width = mask.shape[-2:]
+    if iterations < 1 or height < 3 or width < 3:
+        return result
+
+    distance = _distance_to_false(mask)
+    result[..., 1:-1, 1:-1] = distance[..., 1:-1, 1:-1] > iterations
+    return result
+
+def dilate_array(mask, iterations=1, out=None):
+    """
+    Apply `iterations` passes of 4-neighbour dilation to a binary array.
+
+    Border pixels are never modified. Interior pixels within a taxicab
+    distance of N of a True pixel are set, using a single distance transform.
+    A stack of images of shape (N, H, W) is processed image by image in one call.
+    Pass a boolean out=mask to dilate the mask in place.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    result = _prepare_output(mask, out)
+    height, width = mask.shape[-2:]
+    if iterations < 1 or height < 3 or width < 3:
+        return result
+
+    distance = _distance_to_false(~mask, copy=False)
+    result[..., 1:-1, 1:-1] = distance[..., 1:-1, 1:-1] <= iterations
+    return result
+
+def _erode_reference(img, iterations=1):
+    """Per-pixel erosion used to check parity of erode_array."""
+    img = np.array(img)
+    height, width = img.shape
+
+    for it in range(iterations):
+        delete_i = []
+        delete_j = []
         for i in range(1, height - 1):
             for j in range(1, width - 1):
-                # Check if the current pixel is True and is surrounded by any False pixels
                 if (
                     img[i][j] == True and (
-                        img[i - 1][j] == False or  # Pixel above
-                        img[i][j - 1] == False or  # Pixel to the left
-                        img[i][j + 1] == False or  # Pixel to the right
-                        img[i + 1][j] == False     # Pixel below
+                        img[i - 1][j] == False or
+                        img[i][j - 1] == False or
+                        img[i][j + 1] == False or
+                        img[i + 1][j] == False
                     )
                 ):
-                    delete_i.append(i)  # Add row index
-                    delete_j.append(j)  # Add column index
-
-        # Update identified pixels to False
+                    delete_i.append(i)
+                    delete_j.append(j)
         for i in range(len(delete_i)):
             img[delete_i[i]][delete_j[i]] = False
-
-    # Return the eroded image
     return img
 
-def dilate(img, iterations=1):
-    """
-    Apply dilation to a binary image.
-    """
-    # Convert the image to a NumPy array
+def _dilate_reference(img, iterations=1):
+    """Per-pixel dilation used to check parity of dilate_array."""
     img = np.array(img)
-    height, width = img.shape  # Get image dimensions
-
-    for it in range(iterations):  # Repeat dilation for the specified number of iterations
-        add_pixel_i = []  # List to store row indices of pixels to add
-        add_pixel_j = []  # List to store column indices of pixels to add
+    height, width = img.shape
 
-        # Iterate through each pixel inside the image borders
+    for it in range(iterations):
+        add_pixel_i = []
+        add_pixel_j = []
         for i in range(1, height - 1):
             for j in range(1, width - 1):
-                # Check if the current pixel is False and is adjacent to any True pixels
                 if (
                     img[i][j] == False and (
-                        img[i - 1][j] == True or  # Pixel above
-                        img[i][j - 1] == True or  # Pixel to the left
-                        img[i][j + 1] == True or  # Pixel to the right
-                        img[i + 1][j] == True     # Pixel below
+                        img[i - 1][j] == True or
+                        img[i][j - 1] == True or
+                        img[i][j + 1] == True or
+                        img[i + 1][j] == True
                     )
                 ):
-                    add_pixel_i.append(i)  # Add row index
-                    add_pixel_j.append(j)  # Add column index
-
-        # Update identified pixels to True
+                    add_pixel_i.append(i)
+                    add_pixel_j.append(j)
         for i in range(len(add_pixel_i)):
             img[add_pixel_i[i]][add_pixel_j[i]] = True
+    return img
+
+def erode(img, iterations=1, parity=False):
+    """
+    Apply erosion to a binary image.
+    With parity=True the result is checked as in preprocessing._check_parity.
+    """
+    # Convert the image to a NumPy array
+    img = np.array(img)
+
+    # Erode all iterations at once
+    eroded = erode_array(img, iterations)
+    if parity:
+        _check_parity("erode", eroded, _erode_reference(img, iterations))
+
+    # Return the eroded image
+    return eroded
+
+def dilate(img, iterations=1, parity=False):
+    """
+    Apply dilation to a binary image.
+    With parity=True the result is checked as in preprocessing._check_parity.
+    """
+    # Convert the image to a NumPy array
+    img = np.array(img)
+
+    # Dilate all iterations at once
+    dilated = dilate_array(img, iterations)
+    if parity:
+        _check_parity("dilate", dilated, _dilate_reference(img, iterations))
 
     # Return the dilated image
-    return img
+    return dilated
+
+def filter_array(mask, erosion_iterations=5, dilation_iterations=1, out=None):
+    """
+    Filter a boolean mask like filter_coins, without any image conversion.
+
+    Pass out=mask to filter the mask in place.
+
+    Returns:
+    numpy.ndarray: The filtered boolean mask
+    """
+    eroded = erode_array(mask, erosion_iterations, out=out)
+    return dilate_array(eroded, dilation_iterations, out=eroded)
 
-def filter_coins(segmented_image):
+def filter_coins(segmented_image, erosion_iterations=5, dilation_iterations=1, parity=False):
     """
     Apply a combination of erosion and dilation to filter segmented coins.
     """
     # Apply erosion to the segmented image to remove small noise
-    eroded_image = erode(segmented_image, 5)  # Perform 5 iterations of erosion
+    eroded_image = erode(segmented_image, erosion_iterations, parity)
 
     # Apply dilation to restore the size of remaining objects
-    dilated_image = dilate(eroded_image, 1)  # Perform a single iteration of dilation
+    dilated_image = dilate(eroded_image, dilation_iterations, parity)
 
     # Convert the resulting NumPy array to a PIL Image
     filtered_image = Image.fromarray(dilated_image)
@@ -0,0 +1,332 @@
+"""
+Coin counting over video files and sequences of frames.
+
+Consecutive frames of a conveyor or a fixed camera are mostly identical, so
+each frame is compared with the data the current state was computed from and
+only the regions that changed are processed again: the blurred image, the
+filtered mask and the coin labels are updated around the changed regions
+while the Otsu threshold of the last full pass is reused.
+"""
+import math
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import ndimage as ndi
+from PIL import Image, ImageSequence, UnidentifiedImageError
+
+from preprocessing import preprocess_array, contrast_array, gaussian_blur_array, image_histogram
+from segmentation import otsu_threshold_from_histogram, filter_array
+from counting import count_size_differences
+from loader import expand_image_paths, prefetch_images
+from tiling import grayscale_region
+from instrumentation import record_stage
+
+# Downscaled pixels around a changed source region whose blurred value can
+# change: the LANCZOS support (3 pixels, plus rounding) and the 3x3 blur
+_CHANGE_MARGIN = 5
+
+def _expand(box, margin, shape):
+    """Grow a (top, bottom, left, right) box by margin pixels, clipped to shape."""
+    top, bottom, left, right = box
+    return (max(0, top - margin), min(shape[0], bottom + margin),
+            max(0, left - margin), min(shape[1], right + margin))
+
+def _slices(box, origin=(0, 0)):
+    """Index a (top, bottom, left, right) box in an array whose first pixel is at origin."""
+    top, bottom, left, right = box
+    return slice(top - origin[0], bottom - origin[0]), slice(left - origin[1], right - origin[1])
+
+class StreamCounter:
+    """
+    Count the coins in consecutive frames, reusing the work done on earlier ones.
+
+    Frames are compared with the reference data the current state was
+    computed from, in blocks of block_size x block_size downscaled pixels. A
+    block changes when its mean absolute difference exceeds change_tolerance
+    grey levels; frames without changed blocks reuse the previous result,
+    and frames with a few changed blocks are processed only around them. A
+    frame of a different size, one with more than max_changed_fraction of
+    its blocks changed, or every refresh_interval-th frame is processed in
+    full, which also recomputes the threshold.
+    """
+
+    def __init__(self, scale=2, erosion_iterations=5, dilation_iterations=1, size_threshold=50,
+                 change_tolerance=3.0, block_size=16, max_changed_fraction=0.25,
+                 refresh_interval=100):
+        self.scale = scale
+        self.erosion_iterations = erosion_iterations
+        self.dilation_iterations = dilation_iterations
+        self.size_threshold = size_threshold
+        self.change_tolerance = change_tolerance
+        self.block_size = block_size
+        self.max_changed_fraction = max_changed_fraction
+        self.refresh_interval = refresh_interval
+        self.reset()
+
+    def reset(self):
+        """Forget the previous frames, so that the next one is processed in full."""
+        self.reference = None
+        self.frames_since_refresh = 0
+
+    def update(self, frame):
+        """
+        Count the coins in the next frame.
+
+        Parameters:
+        frame: NumPy array of shape (H, W, C) or PIL Image
+
+        Returns:
+        num_coins: Total number of coins detected
+        size_differences: Number of significant size differences detected among coins
+        mode: 'full', 'partial' or 'reused', depending on how much was processed again
+        """
+        frame = np.asarray(frame)
+        changed = self._changed_blocks(frame)
+
+        if (changed is None or changed.mean() > self.max_changed_fraction or
+                (self.refresh_interval and self.frames_since_refresh >= self.refresh_interval)):
+            with record_stage('stream_full', frame.shape[0] * frame.shape[1]):
+                self._process_full(frame)
+            mode = 'full'
+        elif changed.any():
+            with record_stage('stream_partial', frame.shape[0] * frame.shape[1]):
+                self._process_changed(frame, changed)
+            mode = 'partial'
+        else:
+            mode = 'reused'
+        self.frames_since_refresh += 1
+
+        coin_sizes = self.areas[self.areas > 0]
+        return len(coin_sizes), count_size_differences(coin_sizes, self.size_threshold), mode
+
+    def _changed_blocks(self, frame):
+        """Return which blocks differ from the reference, or None if there is nothing to compare with."""
+        if self.reference is None or frame.shape != self.reference.shape:
+            return None
+
+        difference = np.maximum(frame, self.reference) - np.minimum(frame, self.reference)
+        step = self.block_size * self.scale
+        row_starts = np.arange(0, frame.shape[0], step)
+        col_starts = np.arange(0, frame.shape[1], step)
+
+        # Sum of the differences and number of values in each block
+        sums = np.add.reduceat(np.add.reduceat(difference, row_starts, axis=0, dtype=np.uint64),
+                               col_starts, axis=1)
+        if sums.ndim == 3:
+            sums = sums.sum(axis=2)
+        heights = np.diff(np.append(row_starts, frame.shape[0]))
+        widths = np.diff(np.append(col_starts, frame.shape[1]))
+        channels = frame.shape[2] if frame.ndim == 3 else 1
+        return sums / (np.outer(heights, widths) * channels) > self.change_tolerance
+
+    def _filter(self, blurred):
+        """Threshold and filter blurred pixels like segment_coins and filter_coins."""
+        mask = blurred > self.threshold
+        return filter_array(mask, self.erosion_iterations, self.dilation_iterations, out=mask)
+
+    def _process_full(self, frame):
+        """Process a frame from scratch, exactly like the pipeline."""
+        self.blurred = preprocess_array(frame, self.scale)
+        self.threshold = otsu_threshold_from_histogram(image_histogram(self.blurred))
+        self.mask = self._filter(self.blurred)
+        self._label_all()
+        self.reference = frame.copy()
+        self.frames_since_refresh = 0
+
+    def _label_all(self):
+        """Label the whole mask, discarding the label numbers used so far."""
+        self.labels = np.zeros(self.mask.shape, dtype=np.int32)
+        self.areas = np.zeros(1, dtype=np.int64)  # Area of each label, 0 once it is discarded
+        self.boxes = np.zeros((1, 4), dtype=np.intp)  # (top, bottom, left, right) of each label
+        self._add_labels(self.mask, (0, 0))
+
+    def _add_labels(self, selected, origin):
+        """Label the selected pixels of a region at origin with new label numbers."""
+        labels, num_labels = ndi.label(selected)
+        if num_labels == 0:
+            return
+        sizes = np.bincount(labels.ravel(), minlength=num_labels + 1)[1:]
+        boxes = [(rows.start + origin[0], rows.stop + origin[0], cols.start + origin[1], cols.stop + origin[1])
+                 for rows, cols in ndi.find_objects(labels)]
+
+        first = len(self.areas)
+        self.areas = np.concatenate((self.areas, sizes))
+        self.boxes = np.concatenate((self.boxes, np.array(boxes, dtype=np.intp)))
+        region = self.labels[origin[0]:origin[0] + labels.shape[0], origin[1]:origin[1] + labels.shape[1]]
+        region[labels > 0] = labels[labels > 0] + (first - 1)
+
+    def _process_changed(self, frame, changed):
+        """Update the state around the changed blocks, keeping the threshold."""
+        shape = self.blurred.shape
+        step = self.block_size * self.scale
+        scale_y, scale_x = frame.shape[0] / shape[0], frame.shape[1] / shape[1]
+        halo = self.erosion_iterations + self.dilation_iterations
+
+        # Recompute the blurred image around each group of changed blocks
+        regions = []
+        groups, _ = ndi.label(changed, structure=np.ones((3, 3), dtype=bool))
+        for rows, cols in ndi.find_objects(groups):
+            source = (rows.start * step, rows.stop * step, cols.start * step, cols.stop * step)
+            self.reference[_slices(source)] = frame[_slices(source)]
+
+            box = (int(source[0] / scale_y), math.ceil(source[1] / scale_y),
+                   int(source[2] / scale_x), math.ceil(source[3] / scale_x))
+            box = _expand(box, _CHANGE_MARGIN, shape)
+            self._update_blurred(frame, box)
+            regions.append(_expand(box, halo, shape))
+
+        # Filtered pixels within the halo of a changed blurred pixel can
+        # change; they are filtered again in a window that holds everything
+        # they depend on
+        for region in regions:
+            window = _expand(region, halo + 1, shape)
+            mask = self._filter(self.blurred[_slices(window)])
+            self.mask[_slices(region)] = mask[_slices(region, window[::2])]
+
+        for region in regions:
+            self._update_labels(region)
+
+        # Label numbers are never reused; renumber once most of them are discarded
+        if len(self.areas) > 4 * np.count_nonzero(self.areas) + 1024:
+            self._label_all()
+
+    def _update_blurred(self, frame, box):
+        """Recompute the blurred image inside box from the frame."""
+        hbox = _expand(box, 1, self.blurred.shape)  # One pixel of overlap for the blur kernel
+        gray = grayscale_region(frame, hbox[:2], hbox[2:], self.blurred.shape)
+        tile = gaussian_blur_array(contrast_array(gray, 1.5, out=gray))
+        self.blurred[_slices(box)] = tile[_slices(box, hbox[::2])]
+
+    def _update_labels(self, region):
+        """Label the coins overlapping or touching a region whose mask changed again."""
+        grown = _expand(region, 1, self.mask.shape)
+        touched = np.unique(self.labels[_slices(grown)])
+        touched = touched[touched > 0]
+
+        # The coins touching the region are labeled again in full
+        top, bottom, left, right = grown
+        if touched.size:
+            boxes = self.boxes[touched]
+            top, bottom = min(top, boxes[:, 0].min()), max(bottom, boxes[:, 1].max())
+            left, right = min(left, boxes[:, 2].min()), max(right, boxes[:, 3].max())
+        box = (top, bottom, left, right)
+
+        labels = self.labels[_slices(box)]
+        was_touched = np.isin(labels, touched)
+        selected = np.zeros(labels.shape, dtype=bool)
+        selected[_slices(region, (top, left))] = True
+        selected = self.mask[_slices(box)] & (selected | was_touched)
+
+        labels[was_touched] = 0
+        self.areas[touched] = 0
+        self._add_labels(selected, (top, left))
+
+def _read_ahead(frames, depth=4):
+    """Iterate over frames while a background thread reads up to depth frames ahead."""
+    frames = iter(frames)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        while True:
+            while len(pending) < max(depth, 1):
+                pending.append(executor.submit(next, frames, None))
+            frame = pending.popleft().result()
+            if frame is None:
+                return
+            yield frame
+
+def _video_frames(path):
+    """
+    Decode the frames of a video with OpenCV, or of an animated image with PIL.
+
+    A file that cannot be opened yields a single (name, None, error) tuple,
+    like an unreadable image of a sequence.
+    """
+    name = os.path.basename(path)
+    try:
+        import cv2
+    except ImportError:
+        cv2 = None
+
+    if cv2 is None:
+        try:
+            video = Image.open(path)
+        except UnidentifiedImageError:
+            yield name, None, "OpenCV is needed to read videos (pip install opencv-python)"
+            return
+        except OSError as e:
+            yield name, None, e
+            return
+        with video:
+            for index, frame in enumerate(ImageSequence.Iterator(video)):
+                yield f"{name}#{index}", np.array(frame.convert('RGB')), None
+        return
+
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        yield name, None, f"Cannot open video: {path}"
+        return
+    try:
+        index = 0
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            # OpenCV decodes to BGR
+            yield f"{name}#{index}", np.ascontiguousarray(frame[..., ::-1]), None
+            index += 1
+    finally:
+        capture.release()
+
+def iter_frames(source, depth=4):
+    """
+    Read the frames of a video file, or the images of a directory or glob pattern in name order.
+
+    At most depth frames are decoded ahead of the consumer.
+
+    Yields:
+    tuple: (frame name, frame array, error) where either the array or error is None
+    """
+    if os.path.isfile(source) and not source.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp')):
+        yield from _read_ahead(_video_frames(source), depth)
+        return
+
+    paths = [source] if os.path.isfile(source) else expand_image_paths(source)
+    for image_path, image, error in prefetch_images(paths, depth):
+        name = os.path.basename(image_path)
+        yield (name, None, error) if error is not None else (name, np.asarray(image), None)
+
+def count_stream(source, scale=2, depth=4, **options):
+    """
+    Count the coins in each frame of a video or image sequence, in order.
+
+    Each count is produced as soon as its frame is processed, with at most
+    depth frames read ahead, so the output trails the input by a bounded
+    number of frames.
+
+    Parameters:
+    source: Video file, directory of frames or glob pattern
+    scale: Scale factor for image resizing
+    depth: Number of frames decoded ahead
+    options: Further StreamCounter arguments
+
+    Yields:
+    dict: 'frame', 'count', 'size_differences', 'mode' and processing 'seconds'
+          for each frame, or 'frame' and 'error' for an unreadable frame
+    """
+    counter = StreamCounter(scale, **options)
+    for name, frame, error in iter_frames(source, depth):
+        if error is not None:
+            yield {"frame": name, "error": str(error)}
+            continue
+        start = time.perf_counter()
+        num_coins, size_differences, mode = counter.update(frame)
+        yield {
+            "frame": name,
+            "count": num_coins,
+            "size_differences": size_differences,
+            "mode": mode,
+            "seconds": time.perf_counter() - start,
+        }
@@ -0,0 +1,205 @@
+"""
+Parameter sweep and auto-tuning for the coin counter pipeline.
+
+Every combination of scale, erosion and dilation iterations and size
+threshold is evaluated against ground truth, while each shared stage runs
+only once per image: one segmented mask per scale, one distance transform
+for every erosion count, and one labeling per morphology setting for every
+size threshold.
+"""
+import argparse
+import csv
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from pipeline import run_pipeline
+from segmentation import erode_array_levels, dilate_array
+from counting import label_coins
+from loader import load_image, prefetch_images
+from evaluation import load_ground_truth
+
+def sweep_image(image, scales, erosions, dilations, size_thresholds, threshold_method='otsu'):
+    """
+    Count the coins in one image for every parameter combination.
+
+    Returns:
+    counts: (scale, erosion, dilation, size_threshold) -> (num_coins, size_differences)
+    seconds: (scale, erosion, dilation) -> time a run with only that setting would take
+    """
+    counts, seconds = {}, {}
+    for scale in scales:
+        start = time.perf_counter()
+        mask = run_pipeline(image, ('segmented',), arrays=True, scale=scale,
+                            threshold_method=threshold_method)['segmented']
+        prefix_seconds = time.perf_counter() - start
+
+        # One distance transform gives every erosion count; a single run pays for one
+        start = time.perf_counter()
+        eroded = erode_array_levels(mask, erosions)
+        erosion_seconds = time.perf_counter() - start
+
+        for erosion, dilation in itertools.product(erosions, dilations):
+            start = time.perf_counter()
+            filtered = dilate_array(eroded[erosion], dilation)
+            regions = label_coins(filtered)
+            seconds[(scale, erosion, dilation)] = (prefix_seconds + erosion_seconds +
+                                                   time.perf_counter() - start)
+
+            for size_threshold in size_thresholds:
+                counts[(scale, erosion, dilation, size_threshold)] = regions.count(size_threshold)
+    return counts, seconds
+
+def _sweep_path(image_path, grid, threshold_method, image=None):
+    """Run sweep_image on an image file, returning an error message instead of raising."""
+    try:
+        if image is None:
+            image = load_image(image_path)
+        print(f"Sweeping image: {os.path.basename(image_path)}")
+        return sweep_image(image, *grid, threshold_method), None
+    except Exception as e:
+        return None, str(e)
+
+def recommend(results, tolerance=1.0):
+    """
+    Pick the best trade-off: the fastest combination whose accuracy is
+    within tolerance percentage points of the most accurate one.
+    """
+    if not results:
+        return None
+    best_accuracy = max(result['accuracy'] for result in results)
+    candidates = [result for result in results if result['accuracy'] >= best_accuracy - tolerance]
+    return min(candidates, key=lambda result: (result['seconds_per_image'], -result['accuracy']))
+
+def sweep_dataset(rows, scales=(4, 8), erosions=(3, 5, 7), dilations=(1, 2), size_thresholds=(50,),
+                  threshold_method='otsu', workers=1, prefetch=4):
+    """
+    Evaluate every parameter combination on a set of images with known counts.
+
+    Parameters:
+    rows: (image name, true count, image path) tuples, as from load_ground_truth
+    scales, erosions, dilations, size_thresholds: Values to combine
+    threshold_method: 'otsu' or 'adaptive' (see segment_coins)
+    workers: Number of worker processes
+    prefetch: Number of images decoded ahead in a serial run
+
+    Returns:
+    list: One dict per combination with its parameters, 'accuracy' (percent of
+          exact counts), 'mean_abs_error', 'mean_size_differences' and
+          'seconds_per_image', sorted from the most to the least accurate
+    """
+    grid = (tuple(scales), tuple(erosions), tuple(dilations), tuple(size_thresholds))
+    image_paths = [image_path for _, _, image_path in rows]
+
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        outcomes = executor.map(_sweep_path, image_paths, repeat(grid), repeat(threshold_method))
+    else:
+        executor = None
+        outcomes = (_sweep_path(image_path, grid, threshold_method, image) if error is None else (None, str(error))
+                    for image_path, image, error in prefetch_images(image_paths, prefetch))
+
+    totals = {}  # combination -> [images, correct, absolute error, size differences, seconds]
+    try:
+        for (image_name, true_count, _), (outcome, error) in zip(rows, outcomes):
+            if error is not None:
+                print(f"Error processing {image_name}: {error}")
+                continue
+            counts, seconds = outcome
+            for combination, (num_coins, size_differences) in counts.items():
+                total = totals.setdefault(combination, [0, 0, 0, 0, 0.0])
+                total[0] += 1
+                total[1] += num_coins == true_count
+                total[2] += abs(num_coins - true_count)
+                total[3] += size_differences
+                total[4] += seconds[combination[:3]]
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    results = []
+    for (scale, erosion, dilation, size_threshold), (images, correct, error, differences, seconds) in totals.items():
+        results.append({
+            'scale': scale,
+            'erosion_iterations': erosion,
+            'dilation_iterations': dilation,
+            'size_threshold': size_threshold,
+            'accuracy': 100.0 * correct / images,
+            'mean_abs_error': error / images,
+            'mean_size_differences': differences / images,
+            'seconds_per_image': seconds / images,
+        })
+    results.sort(key=lambda result: (-result['accuracy'], result['seconds_per_image']))
+    return results
+
+def print_sweep(results, recommended=None):
+    """Print the sweep results as a table, marking the recommended combination."""
+    print(f"{'scale':>6}{'erode':>7}{'dilate':>8}{'size thr':>10}{'accuracy':>10}{'MAE':>8}"
+          f"{'sizes':>7}{'ms/image':>10}")
+    for result in results:
+        mark = "  <- recommended" if result is recommended else ""
+        print(f"{result['scale']:>6}{result['erosion_iterations']:>7}{result['dilation_iterations']:>8}"
+              f"{result['size_threshold']:>10}{result['accuracy']:>9.1f}%{result['mean_abs_error']:>8.2f}"
+              f"{result['mean_size_differences']:>7.2f}{result['seconds_per_image'] * 1000:>10.1f}{mark}")
+
+def save_sweep(results, csv_path):
+    """Write the sweep results to a CSV file."""
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0]) if results else ['scale'])
+        writer.writeheader()
+        writer.writerows(results)
+
+def run_sweep(dataset_path, csv_path, scales=(4, 8), erosions=(3, 5, 7), dilations=(1, 2),
+              size_thresholds=(50,), threshold_method='otsu', workers=1, prefetch=4,
+              tolerance=1.0, output_csv="sweep_results.csv"):
+    """
+    Sweep the parameters on a dataset, print the results and recommend a combination.
+
+    Parameters:
+    dataset_path, csv_path: Dataset folder and ground truth CSV, as for batch_evaluate
+    tolerance: Accuracy in percentage points that may be traded for speed
+    output_csv: Where to save the results (None to skip)
+
+    Returns:
+    tuple: (results, recommended combination)
+    """
+    results = sweep_dataset(load_ground_truth(dataset_path, csv_path), scales, erosions, dilations,
+                            size_thresholds, threshold_method, workers, prefetch)
+    recommended = recommend(results, tolerance)
+    print_sweep(results, recommended)
+    if recommended is not None:
+        print(f"\nRecommended: scale={recommended['scale']}, "
+              f"erosion_iterations={recommended['erosion_iterations']}, "
+              f"dilation_iterations={recommended['dilation_iterations']}, "
+              f"size_threshold={recommended['size_threshold']} "
+              f"({recommended['accuracy']:.1f}% accuracy, "
+              f"{recommended['seconds_per_image'] * 1000:.1f} ms per image)")
+    if output_csv:
+        save_sweep(results, output_csv)
+        print(f"Sweep results saved to {output_csv}")
+    return results, recommended
+
+def main():
+    """Run a parameter sweep from the command line."""
+    parser = argparse.ArgumentParser(description='Coin Counter parameter sweep')
+    parser.add_argument('dataset_path', help='Folder containing the image folders')
+    parser.add_argument('csv_path', help='Ground truth CSV with folder, image_name and coins_count columns')
+    parser.add_argument('--scales', nargs='+', type=int, default=[4, 8], help='Scale factors')
+    parser.add_argument('--erosions', nargs='+', type=int, default=[3, 5, 7], help='Erosion iterations')
+    parser.add_argument('--dilations', nargs='+', type=int, default=[1, 2], help='Dilation iterations')
+    parser.add_argument('--size-thresholds', nargs='+', type=int, default=[50], help='Size thresholds')
+    parser.add_argument('--threshold', choices=['otsu', 'adaptive'], default='otsu', help='Thresholding method')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--tolerance', type=float, default=1.0,
+                        help='Accuracy in percentage points that may be traded for speed')
+    parser.add_argument('--output', type=str, default='sweep_results.csv', help='CSV file for the results')
+    args = parser.parse_args()
+
+    run_sweep(args.dataset_path, args.csv_path, args.scales, args.erosions, args.dilations,
+              args.size_thresholds, args.threshold, args.jobs, tolerance=args.tolerance,
+              output_csv=args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""
+Tiled, out-of-core processing for very large images.
+
+The image is processed in overlapping tiles so that only one tile's worth of
+full-resolution data is in memory at a time. The blurred, downscaled image is
+spooled to a temporary memory-mapped file between the two passes, and
+connected components are merged across tile seams, so the count matches the
+one computed on the full image.
+"""
+import math
+import os
+import tempfile
+
+import numpy as np
+from scipy import ndimage as ndi
+from PIL import Image
+
+from preprocessing import grayscale_array, contrast_array, gaussian_blur_array
+from segmentation import otsu_threshold_from_histogram, filter_array
+from counting import count_size_differences
+from instrumentation import record_stage
+
+# Rough number of bytes held in memory per downscaled tile pixel, on top of
+# the full-resolution source crop: grayscale, contrast, blurred, masks,
+# distance transform and labels.
+_BYTES_PER_TILE_PIXEL = 48
+
+def open_raw_image(path, height, width, channels=3):
+    """
+    Memory-map a raw interleaved 8-bit image file without reading it.
+
+    Parameters:
+    path: Path to the raw file (height * width * channels bytes, row-major)
+    height, width, channels: Image dimensions
+
+    Returns:
+    numpy.memmap: Read-only array of shape (height, width, channels)
+    """
+    return np.memmap(path, dtype=np.uint8, mode='r', shape=(height, width, channels))
+
+def tile_size_for_budget(memory_budget, scale):
+    """Return the side of a square output tile that keeps a tile within memory_budget bytes."""
+    # Each output pixel needs scale * scale source pixels, held twice while resizing
+    bytes_per_pixel = 2 * 4 * scale * scale + _BYTES_PER_TILE_PIXEL
+    return max(64, int(math.sqrt(memory_budget / bytes_per_pixel)))
+
+def _tile_ranges(length, tile_size):
+    """Split range(length) into consecutive (start, stop) chunks of tile_size."""
+    return [(start, min(start + tile_size, length)) for start in range(0, length, tile_size)]
+
+def grayscale_region(source, rows, cols, out_shape):
+    """
+    Compute the downscaled grayscale of an output region, like convert_to_grayscale.
+
+    Only the source pixels under the region plus the LANCZOS filter support are
+    read. The resize of a tile may differ from the full-image resize by one grey
+    level at a few pixels because of floating-point rounding.
+    """
+    height, width = source.shape[:2] if isinstance(source, np.ndarray) else source.size[::-1]
+    out_height, out_width = out_shape
+    scale_y, scale_x = height / out_height, width / out_width
+
+    # Source box of the region and the crop including the filter support
+    y0, y1 = rows[0] * scale_y, rows[1] * scale_y
+    x0, x1 = cols[0] * scale_x, cols[1] * scale_x
+    margin = int(math.ceil(3 * max(scale_y, scale_x))) + 2
+    crop_y0, crop_y1 = max(0, int(y0) - margin), min(height, int(math.ceil(y1)) + margin)
+    crop_x0, crop_x1 = max(0, int(x0) - margin), min(width, int(math.ceil(x1)) + margin)
+
+    if isinstance(source, np.ndarray):
+        crop = Image.fromarray(np.ascontiguousarray(source[crop_y0:crop_y1, crop_x0:crop_x1]))
+    else:
+        crop = source.crop((crop_x0, crop_y0, crop_x1, crop_y1))
+
+    resized = crop.resize((cols[1] - cols[0], rows[1] - rows[0]), Image.Resampling.LANCZOS,
+                          box=(x0 - crop_x0, y0 - crop_y0, x1 - crop_x0, y1 - crop_y0))
+    return grayscale_array(np.array(resized))
+
+def _preprocess_tiles(source, out_shape, tile_size, blurred):
+    """
+    First pass: write the blurred image into `blurred` tile by tile.
+
+    Returns:
+    numpy.ndarray: Histogram of the blurred image
+    """
+    out_height, out_width = out_shape
+    histogram = np.zeros(256, dtype=np.int64)
+
+    for r0, r1 in _tile_ranges(out_height, tile_size):
+        for c0, c1 in _tile_ranges(out_width, tile_size):
+            # One pixel of overlap for the 3x3 blur kernel
+            hr0, hr1 = max(0, r0 - 1), min(out_height, r1 + 1)
+            hc0, hc1 = max(0, c0 - 1), min(out_width, c1 + 1)
+
+            gray = grayscale_region(source, (hr0, hr1), (hc0, hc1), out_shape)
+            tile = gaussian_blur_array(contrast_array(gray, 1.5, out=gray))
+
+            # The blur leaves the tile's outer pixels at zero: they are either
+            # overlap, which is dropped, or the border of the full image,
+            # which apply_gaussian_blur also leaves at zero
+            core = tile[r0 - hr0:r1 - hr0, c0 - hc0:c1 - hc0]
+
+            blurred[r0:r1, c0:c1] = core
+            histogram += np.bincount(core.ravel(), minlength=256)
+
+    return histogram
+
+class _UnionFind:
+    """Disjoint sets over labels 0..n, grown on demand."""
+
+    def __init__(self):
+        self.parent = [0]
+
+    def add(self, count):
+        start = len(self.parent)
+        self.parent.extend(range(start, start + count))
+
+    def find(self, label):
+        root = label
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[label] != root:
+            self.parent[label], label = root, self.parent[label]
+        return root
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+def _union_seam(sets, first, second):
+    """Merge the labels of touching foreground pixels on either side of a seam."""
+    touching = (first > 0) & (second > 0)
+    for a, b in set(zip(first[touching].tolist(), second[touching].tolist())):
+        sets.union(a, b)
+
+def _label_tiles(blurred, threshold, tile_size, erosion_iterations, dilation_iterations):
+    """
+    Second pass: threshold, filter and label the blurred image tile by tile.
+
+    Returns:
+    numpy.ndarray: Area of each coin, with components merged across seams
+    """
+    out_height, out_width = blurred.shape
+    halo = erosion_iterations + dilation_iterations + 1
+    sets = _UnionFind()
+    sizes = [0]
+    bottom_rows = {}  # column range -> labels of the last row of the tile above
+
+    for r0, r1 in _tile_ranges(out_height, tile_size):
+        right_col = None  # labels of the last column of the tile to the left
+        for c0, c1 in _tile_ranges(out_width, tile_size):
+            hr0, hr1 = max(0, r0 - halo), min(out_height, r1 + halo)
+            hc0, hc1 = max(0, c0 - halo), min(out_width, c1 + halo)
+
+            # Pixels further than the halo from a tile edge inside the image
+            # are filtered exactly as on the full image
+            mask = np.asarray(blurred[hr0:hr1, hc0:hc1]) > threshold
+            filter_array(mask, erosion_iterations, dilation_iterations, out=mask)
+            core = mask[r0 - hr0:r1 - hr0, c0 - hc0:c1 - hc0]
+
+            # Label the tile and shift its labels after those of earlier tiles
+            labels, num_labels = ndi.label(core)
+            sizes.extend(np.bincount(labels.ravel(), minlength=num_labels + 1)[1:].tolist())
+            labels[labels > 0] += len(sets.parent) - 1
+            sets.add(num_labels)
+
+            if (c0, c1) in bottom_rows:
+                _union_seam(sets, bottom_rows[(c0, c1)], labels[0])
+            if right_col is not None:
+                _union_seam(sets, right_col, labels[:, 0])
+            bottom_rows[(c0, c1)] = labels[-1].copy()
+            right_col = labels[:, -1].copy()
+
+    roots = np.array([sets.find(label) for label in range(len(sizes))], dtype=np.int64)
+    merged = np.bincount(roots[1:], weights=sizes[1:], minlength=len(sizes))
+    return merged[np.unique(roots[1:])].astype(np.int64)
+
+def count_coins_tiled(source, scale=2, erosion_iterations=5, dilation_iterations=1,
+                      size_threshold=50, memory_budget=256 * 1024 * 1024, tile_size=None,
+                      workdir=None):
+    """
+    Count the coins in a large image without holding it in memory at full resolution.
+
+    Produces the same result as running the full pipeline on the whole image,
+    up to the rounding noted in grayscale_region.
+
+    Parameters:
+    source: PIL Image, NumPy array of shape (H, W, C), or a memory-mapped raw
+            file from open_raw_image
+    scale: Scale factor for image resizing
+    erosion_iterations, dilation_iterations: Morphology passes, as in filter_coins
+    size_threshold: Threshold for significant size differences between coins
+    memory_budget: Approximate peak memory in bytes for one tile
+    tile_size: Side of a tile in downscaled pixels (derived from memory_budget if omitted)
+    workdir: Directory for the temporary blurred image (system default if omitted)
+
+    Returns:
+    num_coins: Total number of coins detected
+    size_differences: Number of significant size differences detected among coins
+    """
+    height, width = source.shape[:2] if isinstance(source, np.ndarray) else source.size[::-1]
+    out_shape = (height // scale, width // scale)
+    if tile_size is None:
+        tile_size = tile_size_for_budget(memory_budget, scale)
+
+    fd, spool_path = tempfile.mkstemp(suffix='.blurred', dir=workdir)
+    os.close(fd)
+    try:
+        blurred = np.memmap(spool_path, dtype=np.uint8, mode='w+', shape=out_shape)
+
+        with record_stage('tiled_preprocess', height * width):
+            histogram = _preprocess_tiles(source, out_shape, tile_size, blurred)
+        threshold = otsu_threshold_from_histogram(histogram)
+
+        with record_stage('tiled_label', out_shape[0] * out_shape[1]):
+            coin_sizes = _label_tiles(blurred, threshold, tile_size,
+                                      erosion_iterations, dilation_iterations)
+        del blurred
+    finally:
+        os.remove(spool_path)
+
+    num_coins = len(coin_sizes)
+    return num_coins, count_size_differences(coin_sizes, size_threshold)
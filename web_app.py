@@ -1,18 +1,29 @@
 """
 Web interface for the Coin Counter application.
+
+`python web_app.py` starts the debug server. `python web_app.py --workers N`
+serves with N preforked pipeline worker processes (see workers.py) and
+answers 503 once --max-concurrent images are being processed.
 """
 import os
+import argparse
 import uuid
+import hashlib
 import numpy as np
-from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory
+from flask import (Flask, render_template, request, redirect, url_for, flash, send_from_directory, jsonify,
+                   abort)
 from werkzeug.utils import secure_filename
 from PIL import Image
 import io
 import base64
 
-from preprocessing import preprocess_image
-from segmentation import segment_coins, filter_coins
-from counting import count_coins, create_labeled_visualization
+from pipeline import run_pipeline, DEFAULT_PARAMS
+from cache import ResultCache, make_cache_key
+from jobs import JobQueue, QueueFullError
+from workers import PipelinePool
+from loader import load_image
+import instrumentation
+from instrumentation import record_stage, input_pixels
 
 # Configure application
 app = Flask(__name__)
@@ -20,61 +31,152 @@ app.config['SECRET_KEY'] = 'coin_counter_secret_key'
 app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload size
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif'}
+app.config['RESULT_CACHE_SIZE'] = 64  # Number of results kept in memory
+app.config['RESULT_CACHE_DIR'] = os.environ.get('COIN_COUNTER_CACHE_DIR')  # Optional on-disk tier
+app.config['JOB_WORKERS'] = 2  # Worker threads for asynchronous uploads
+app.config['JOB_QUEUE_SIZE'] = 8  # Asynchronous uploads queued or running before new ones are rejected
+app.config['TRACE_MEMORY'] = os.environ.get('COIN_COUNTER_TRACE_MEMORY') == '1'  # Per-stage peak memory in /metrics
+app.config['PREVIEW_SIZE'] = 640  # Maximum side in pixels of the images on the results page
+app.config['PREVIEW_CACHE_SIZE'] = 256  # Number of encoded previews kept in memory
+app.config['PREVIEW_MAX_AGE'] = 24 * 3600  # Seconds browsers may reuse a preview without asking again
+app.config['RETRY_AFTER'] = 5  # Seconds a client is asked to wait after a 503
 
 # Create uploads folder if it doesn't exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+if app.config['TRACE_MEMORY']:
+    instrumentation.enable_memory_tracking()
+
+# Results of previously processed images, keyed on image content and parameters
+result_cache = ResultCache(app.config['RESULT_CACHE_SIZE'], app.config['RESULT_CACHE_DIR'], namespace='web')
+
+# Encoded preview images, keyed on upload, kind, scale and size
+preview_cache = ResultCache(app.config['PREVIEW_CACHE_SIZE'], namespace='previews')
+
+# Background workers for asynchronous uploads
+job_queue = JobQueue(app.config['JOB_WORKERS'], app.config['JOB_QUEUE_SIZE'])
+
+# Pipeline worker processes; None runs the pipeline in the request thread (see serve)
+pipeline_pool = None
+
+def run_counting(image, outputs, wait=False, **params):
+    """
+    Run the pipeline on an image in the worker pool if one is running, and in this thread otherwise.
+    
+    Raises:
+    QueueFullError: If the worker pool is saturated and wait is False
+    """
+    if pipeline_pool is not None:
+        return pipeline_pool.run(image, outputs, wait=wait, **params)
+    return run_pipeline(image, outputs, **params)
+
+@app.errorhandler(QueueFullError)
+def server_busy(error):
+    """Shed load: answer 503 with a Retry-After header when no worker is free."""
+    response = jsonify({'error': f'Server busy, {error}'})
+    response.headers['Retry-After'] = str(app.config['RETRY_AFTER'])
+    return response, 503
+
 def allowed_file(filename):
     """Check if the file extension is allowed."""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
-def process_image(image_path, scale=2):
-    """Process an image and return the results."""
+def _label_palette():
+    """Return a 256-colour palette: black background and well-separated colours for the coins."""
+    hues = (np.arange(255) * 0.618033988749895) % 1.0  # Golden-ratio steps between neighbouring labels
+    colors = Image.fromarray(np.stack([hues * 255, np.full(255, 200), np.full(255, 255)], axis=1)
+                             .astype(np.uint8)[None], 'HSV').convert('RGB')
+    return [0, 0, 0] + np.asarray(colors).ravel().tolist()
+
+LABEL_PALETTE = _label_palette()
+
+def labeled_to_image(labeled_image):
+    """Convert a labeled array to a palette PIL Image, with one colour per coin (colours repeat after 255 coins)."""
+    labeled_image = np.asarray(labeled_image)
+    if labeled_image.dtype == np.uint8:
+        # Compact labels of up to 255 coins are already palette indices
+        indices = labeled_image
+    else:
+        indices = np.zeros(labeled_image.shape, dtype=np.uint8)
+        coins = labeled_image > 0
+        indices[coins] = (labeled_image[coins] - 1) % 255 + 1
+    image = Image.fromarray(indices, 'P')
+    image.putpalette(LABEL_PALETTE)
+    return image
+
+def encode_image(image, image_format, **options):
+    """Encode a PIL Image in the given format and return the bytes."""
+    buffered = io.BytesIO()
+    image.save(buffered, format=image_format, **options)
+    return buffered.getvalue()
+
+def encode_base64(image, image_format):
+    """Encode a PIL Image in the given format as a base64 string."""
+    return base64.b64encode(encode_image(image, image_format)).decode('utf-8')
+
+def make_preview(image, preview_size, resample=Image.Resampling.LANCZOS):
+    """Return a copy of an image downscaled to fit preview_size (0 keeps the full size)."""
+    image = image.copy()
+    if preview_size > 0:
+        image.thumbnail((preview_size, preview_size), resample)
+    return image
+
+def process_image(image_path, scale=2, wait=False):
+    """Process an image and return the results, reusing cached results for identical images."""
+    key = make_cache_key(image_path, {**DEFAULT_PARAMS, 'scale': scale})
+    return result_cache.get_or_compute(key, lambda: compute_results(image_path, scale, wait))
+
+def compute_results(image_path, scale=2, wait=False):
+    """Run the pipeline on an image and encode the labeled image as a palette PNG."""
     # Load the image
-    original_image = Image.open(image_path)
-    
-    # Preprocess the image
-    preprocessed_image = preprocess_image(original_image, scale)
-    
-    # Segment the image
-    segmented_image = segment_coins(preprocessed_image)
+    original_image = load_image(image_path)
     
-    # Filter the segmented image
-    filtered_image = filter_coins(segmented_image)
+    # Count the coins and create the labeled visualization
+    results = run_counting(original_image, ('count', 'labeled'), wait, scale=scale)
+    num_coins, size_differences = results['count']
+    labeled_image = results['labeled']
     
-    # Count the coins
-    num_coins, size_differences = count_coins(filtered_image)
-    
-    # Create visualization
-    labeled_image = create_labeled_visualization(filtered_image)
-    
-    # Convert NumPy array to PIL Image for saving
-    labeled_pil = Image.fromarray(np.uint8(labeled_image * 255 / np.max(labeled_image)))
-    
-    # Convert images to base64 for display
-    buffered = io.BytesIO()
-    labeled_pil.save(buffered, format="PNG")
-    labeled_image_b64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-    
-    buffered = io.BytesIO()
-    original_image.save(buffered, format="PNG")
-    original_image_b64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
+    # The original is served from the upload itself, so only the labels are encoded
+    with record_stage('encode', input_pixels(labeled_image)):
+        labeled_png = encode_image(labeled_to_image(labeled_image), "PNG")
     
     return {
         'num_coins': num_coins,
         'size_differences': size_differences,
-        'original_image': original_image_b64,
-        'labeled_image': labeled_image_b64
+        'labeled_png': labeled_png
     }
 
+def process_upload(filepath, scale=2, wait=False):
+    """Process an uploaded image and add what the results page needs to link its images."""
+    return {**process_image(filepath, scale, wait), 'filename': os.path.basename(filepath), 'scale': scale}
+
 @app.route('/')
 def index():
     """Render the main page."""
     return render_template('index.html')
 
+def render_results(results):
+    """Render the results page for processed upload results (see process_upload)."""
+    filename, scale = results['filename'], results['scale']
+    return render_template('results.html', 
+                          num_coins=results['num_coins'],
+                          size_differences=results['size_differences'],
+                          original_url=url_for('result_image', filename=filename, kind='original'),
+                          labeled_url=url_for('result_image', filename=filename, kind='labeled', scale=scale),
+                          original_full_url=url_for('uploaded_file', filename=filename),
+                          labeled_full_url=url_for('result_image', filename=filename, kind='labeled',
+                                                   scale=scale, full=1))
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    """Handle file upload and process the image."""
+    """
+    Handle file upload and process the image.
+    
+    With an 'async' form or query field set to 1, the image is queued for
+    processing and a job id is returned as JSON right away (202), or 503 if
+    the job queue is full. Synchronous uploads get 503 when the pipeline
+    workers are saturated.
+    """
     if 'file' not in request.files:
         flash('No file part')
         return redirect(request.url)
@@ -86,28 +188,256 @@ def upload_file():
         return redirect(request.url)
     
     if file and allowed_file(file.filename):
+        scale = request.form.get('scale', '2')
+        if not scale.isdigit() or int(scale) < 1:
+            flash('Scale must be a whole number of at least 1.')
+            return redirect(url_for('index'))
+        scale = int(scale)
+        
         # Generate a unique filename
         filename = str(uuid.uuid4()) + '_' + secure_filename(file.filename)
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         file.save(filepath)
         
+        # Queue the image for background processing if requested
+        if request.values.get('async') == '1':
+            try:
+                # Queued jobs wait for a pipeline worker instead of failing
+                job_id = job_queue.submit(process_upload, filepath, scale, True)
+            except QueueFullError:
+                os.remove(filepath)
+                raise
+            return jsonify({'job_id': job_id,
+                            'status_url': url_for('job_status', job_id=job_id),
+                            'result_url': url_for('job_result', job_id=job_id)}), 202
+        
         # Process the image
-        scale = int(request.form.get('scale', 2))
-        results = process_image(filepath, scale)
+        try:
+            results = process_upload(filepath, scale)
+        except QueueFullError:
+            os.remove(filepath)
+            raise
         
-        return render_template('results.html', 
-                              num_coins=results['num_coins'],
-                              size_differences=results['size_differences'],
-                              original_image=results['original_image'],
-                              labeled_image=results['labeled_image'])
+        return render_results(results)
     
     flash('Invalid file type. Please upload an image file (png, jpg, jpeg, gif).')
     return redirect(url_for('index'))
 
+def count_image_json(image, filename, scale=2, size_threshold=50, stats=False,
+                     images=False, preview_size=256, threshold_method='otsu'):
+    """
+    Count the coins in an image and return JSON-serializable results.
+    
+    Parameters:
+    image: The uploaded image
+    filename: Name reported back to the client
+    scale: Scale factor for image resizing
+    size_threshold: Threshold for significant size differences between coins
+    stats: Whether to include per-coin measurements (see CoinRegions.coins) and size classes
+    images: Whether to include base64 previews of the original and labeled images
+    preview_size: Maximum side of the previews in pixels (0 for full size)
+    threshold_method: 'otsu' or 'adaptive' (see segment_coins)
+    
+    Returns:
+    dict: Results for this image
+    """
+    outputs = ('count', 'regions') if stats or images else ('count',)
+    stages = run_counting(image, outputs, scale=scale, size_threshold=size_threshold,
+                          threshold_method=threshold_method)
+    num_coins, size_differences = stages['count']
+    
+    result = {
+        'filename': filename,
+        'num_coins': num_coins,
+        'size_differences': size_differences
+    }
+    
+    if stats:
+        result['size_classes'] = stages['regions'].size_classes(size_threshold)
+        result['coins'] = stages['regions'].coins()
+    
+    if images:
+        with record_stage('encode', input_pixels(image)):
+            original_preview = make_preview(image.convert('RGB'), preview_size)
+            labeled_preview = make_preview(labeled_to_image(stages['regions'].labels), preview_size,
+                                           Image.Resampling.NEAREST)
+            result['original_image'] = encode_base64(original_preview, "JPEG")
+            result['labeled_image'] = encode_base64(labeled_preview, "PNG")
+    
+    return result
+
+@app.route('/api/count', methods=['POST'])
+def api_count():
+    """
+    Count the coins in one or more images and return the results as JSON.
+    
+    Accepts a multipart request with one or more 'files' (or 'file') parts
+    and the optional fields 'scale', 'size_threshold', 'threshold' ('otsu' or
+    'adaptive'), 'stats' (1 to include
+    per-coin measurements), 'images' (1 to include previews) and
+    'preview_size' (maximum preview side in pixels, 0 for full size).
+    """
+    files = request.files.getlist('files') + request.files.getlist('file')
+    if not files:
+        return jsonify({'error': 'No files uploaded'}), 400
+    
+    try:
+        scale = int(request.form.get('scale', 2))
+        size_threshold = int(request.form.get('size_threshold', DEFAULT_PARAMS['size_threshold']))
+        preview_size = int(request.form.get('preview_size', 256))
+    except ValueError:
+        return jsonify({'error': 'scale, size_threshold and preview_size must be integers'}), 400
+    if scale < 1 or preview_size < 0:
+        return jsonify({'error': 'scale must be at least 1 and preview_size must not be negative'}), 400
+    threshold_method = request.form.get('threshold', 'otsu')
+    if threshold_method not in ('otsu', 'adaptive'):
+        return jsonify({'error': "threshold must be 'otsu' or 'adaptive'"}), 400
+    stats = request.form.get('stats') == '1'
+    images = request.form.get('images') == '1'
+    
+    results = []
+    for file in files:
+        if not allowed_file(file.filename):
+            results.append({'filename': file.filename, 'error': 'Invalid file type'})
+            continue
+        try:
+            # Decode straight from the upload stream, without saving the file
+            image = load_image(file.stream)
+            results.append(count_image_json(image, file.filename, scale, size_threshold,
+                                            stats, images, preview_size, threshold_method))
+        except QueueFullError:
+            raise
+        except Exception as e:
+            results.append({'filename': file.filename, 'error': str(e)})
+    
+    return jsonify({'results': results})
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Return the status of an asynchronous upload as JSON, with the counts once it is done."""
+    status = job_queue.status(job_id)
+    if status is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    
+    body = {'job_id': job_id, 'status': status}
+    if status == 'done':
+        results = job_queue.result(job_id)
+        body.update(num_coins=results['num_coins'],
+                    size_differences=results['size_differences'],
+                    result_url=url_for('job_result', job_id=job_id))
+    return jsonify(body)
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    """Render the results page of a finished asynchronous upload."""
+    status = job_queue.status(job_id)
+    if status is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if status in ('queued', 'running'):
+        return jsonify({'job_id': job_id, 'status': status}), 202
+    if status == 'failed':
+        return jsonify({'job_id': job_id, 'status': status, 'error': 'Processing failed'}), 500
+    
+    return render_results(job_queue.result(job_id))
+
+@app.route('/metrics')
+def metrics():
+    """Expose per-stage timing and memory histograms in the Prometheus text format."""
+    return instrumentation.render_prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+def make_result_image(filepath, kind, scale, size):
+    """
+    Encode the original or labeled image of an upload, downscaled to fit size (0 for full size).
+    
+    Returns:
+    tuple: (encoded bytes, MIME type)
+    """
+    if kind == 'original':
+        with record_stage('encode', 0):
+            preview = make_preview(load_image(filepath).convert('RGB'), size)
+            return encode_image(preview, "JPEG", quality=85), 'image/jpeg'
+    
+    labeled_png = process_image(filepath, scale)['labeled_png']
+    if size == 0:
+        return labeled_png, 'image/png'
+    with record_stage('encode', 0):
+        preview = make_preview(Image.open(io.BytesIO(labeled_png)), size, Image.Resampling.NEAREST)
+        return encode_image(preview, "PNG"), 'image/png'
+
+@app.route('/images/<filename>/<kind>')
+def result_image(filename, kind):
+    """
+    Serve the original or labeled image of an upload as a cacheable preview.
+    
+    Previews are at most PREVIEW_SIZE pixels on a side; 'full=1' returns the
+    labeled image at full size and 'size' picks another preview size. Uploads
+    never change, so the ETag only depends on the request, and a matching
+    If-None-Match is answered with 304 without touching the image.
+    """
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    if kind not in ('original', 'labeled') or filename != os.path.basename(filename) or not os.path.isfile(filepath):
+        abort(404)
+    try:
+        scale = int(request.args.get('scale', 2))
+        size = 0 if request.args.get('full') == '1' else int(request.args.get('size', app.config['PREVIEW_SIZE']))
+    except ValueError:
+        abort(400)
+    if scale < 1 or size < 0:
+        abort(400)
+    if kind == 'original' and size == 0:
+        return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    
+    etag = hashlib.sha256(f"{filename}/{kind}/{scale}/{size}".encode('utf-8')).hexdigest()[:32]
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        data, mimetype = preview_cache.get_or_compute(
+            etag, lambda: make_result_image(filepath, kind, scale, size))
+        response = app.response_class(data, mimetype=mimetype)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['PREVIEW_MAX_AGE']
+    return response
+
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
     """Serve uploaded files."""
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
 
+def serve(host='127.0.0.1', port=5000, workers=0, max_concurrent=None, debug=True):
+    """
+    Serve the application.
+    
+    Parameters:
+    host, port: Address to listen on
+    workers: Number of preforked pipeline worker processes (0 runs the
+             pipeline in the request threads)
+    max_concurrent: Images processed or waiting for a worker at once before
+                    requests are answered with 503 (default: twice the workers)
+    debug: Whether to run the debug server, with the reloader, when workers is 0
+    """
+    global pipeline_pool
+    if workers <= 0:
+        app.run(host=host, port=port, debug=debug, threaded=True)
+        return
+    
+    # Fork the workers before the server starts any threads
+    pipeline_pool = PipelinePool(workers, max_concurrent)
+    print(f"Started {workers} pipeline workers, at most {pipeline_pool.max_concurrent} images at once")
+    try:
+        app.run(host=host, port=port, threaded=True)
+    finally:
+        pipeline_pool.close()
+
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Coin Counter web application')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=5000, help='Port to listen on')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Preforked pipeline worker processes (0 runs the pipeline in the request threads)')
+    parser.add_argument('--max-concurrent', type=int,
+                        help='Images in flight before answering 503 (default: twice the workers)')
+    parser.add_argument('--no-debug', action='store_true',
+                        help='Without --workers, run without the debug server and its reloader')
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers, args.max_concurrent, not args.no_debug)
\ No newline at end of file
@@ -0,0 +1,122 @@
+"""
+Preforked pipeline worker processes for the coin counter web application.
+
+The pipeline is CPU-bound, so request threads of a single process contend
+for the GIL. PipelinePool runs it in warm worker processes instead: the
+workers are started up front with the pipeline modules imported and
+exercised once, and decoded images are handed to them through shared memory
+rather than pickled. At most max_concurrent images are in flight; beyond
+that run() raises QueueFullError so the server can shed load.
+"""
+import os
+import signal
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from pipeline import run_pipeline
+from jobs import QueueFullError
+import instrumentation
+
+def _init_worker():
+    """Leave Ctrl+C to the server process, which shuts the workers down."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _warm_up():
+    """Run the whole pipeline once on a tiny image so the first request pays no start-up cost."""
+    image = np.zeros((32, 32, 3), dtype=np.uint8)
+    image[8:24, 8:24] = 60
+    run_pipeline(image, ('count', 'labeled'), arrays=True)
+    instrumentation.reset()
+    return True
+
+def _run_shared(name, shape, dtype, outputs, params):
+    """
+    Run the pipeline in a worker on an image held in shared memory.
+
+    Returns:
+    tuple: (pipeline results, stage statistics of this run)
+    """
+    # The parent creates and unlinks the block. Before Python 3.13, attaching
+    # to it on POSIX also registers it with this worker's resource tracker,
+    # which would unlink it (and warn about a leak) when the worker exits
+    # while the parent may still be using it, so the worker gives it up.
+    if sys.version_info >= (3, 13):
+        block = shared_memory.SharedMemory(name=name, track=False)
+    else:
+        block = shared_memory.SharedMemory(name=name)
+        if os.name == 'posix':
+            # The tracker knows POSIX blocks by their name with a leading slash
+            resource_tracker.unregister('/' + block.name, 'shared_memory')
+    try:
+        image = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        image.flags.writeable = False
+        instrumentation.reset()
+        results = run_pipeline(image, outputs, arrays=True, **params)
+        # Results that still view the shared image must not outlive the block
+        results = {key: value.copy() if isinstance(value, np.ndarray) and np.shares_memory(value, image)
+                   else value for key, value in results.items()}
+        del image
+        return results, instrumentation.snapshot()
+    finally:
+        block.close()
+
+class PipelinePool:
+    """
+    Pool of warm worker processes running the pipeline with a concurrency limit.
+
+    Parameters:
+    workers: Number of worker processes, all started by the constructor
+    max_concurrent: Maximum number of images queued or running at once
+                    (defaults to twice the number of workers)
+    """
+
+    def __init__(self, workers=2, max_concurrent=None):
+        self.workers = workers
+        self.max_concurrent = max_concurrent or 2 * workers
+        self._executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+        self._slots = threading.BoundedSemaphore(self.max_concurrent)
+        # Start and warm every worker now rather than on the first requests
+        for future in [self._executor.submit(_warm_up) for _ in range(workers)]:
+            future.result()
+
+    def run(self, image, outputs=('count',), wait=False, **params):
+        """
+        Run the pipeline on an image in a worker process, like run_pipeline(..., arrays=True).
+
+        Parameters:
+        image: PIL Image or NumPy array
+        outputs: Names of the results to return
+        wait: Wait for a free slot instead of failing when the pool is saturated
+        params: Pipeline parameters (see run_pipeline)
+
+        Returns:
+        dict: Mapping of each requested output name to its result
+
+        Raises:
+        QueueFullError: If max_concurrent images are already in flight and wait is False
+        """
+        if not self._slots.acquire(blocking=wait):
+            raise QueueFullError("All pipeline workers are busy")
+        try:
+            array = np.ascontiguousarray(np.asarray(image))
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            try:
+                np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+                future = self._executor.submit(_run_shared, block.name, array.shape, array.dtype.str,
+                                               tuple(outputs), params)
+                results, stage_stats = future.result()
+            finally:
+                block.close()
+                block.unlink()
+        finally:
+            self._slots.release()
+        instrumentation.merge(stage_stats)
+        return results
+
+    def close(self):
+        """Stop the worker processes."""
+        self._executor.shutdown()